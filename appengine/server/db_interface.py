@@ -2,10 +2,19 @@
 """
 
 import logging
+
+from google.appengine.api import datastore_errors
 import models
+import sketch_pool
+import write_behind
 
 _LOG = logging
 
+# EmotionMetrics are written in batches, off the request path.
+_emotion_metrics_buffer = write_behind.WriteBehindBuffer()
+# The next sketches of get_svg, fetched ahead of time.
+_sketch_pool = sketch_pool.SketchCandidatePool()
+
 
 def store_emotion_metrics(emo_dict,
                           episode_id,
@@ -28,11 +37,12 @@ def store_emotion_metrics(emo_dict,
     experiment_description: Long form text describing the experiment.
 
   Returns:
-    The EmotionMetrics db object created.
+    The EmotionMetrics db object created. It is written by a background
+    writer shortly after, until then it has no key.
   """
   _LOG.debug('In DB interface. User ID is:\n%s', user_id)
 
-  emo_model = models.EmotionMetrics.CreateAndStore(
+  emo_model = models.EmotionMetrics.Create(
       int(user_id),
       episode_id,
       int(sample_id),
@@ -43,10 +53,25 @@ def store_emotion_metrics(emo_dict,
       time_elapsed=time_elapsed,
       experiment_name=experiment_name,
       experiment_description=experiment_description)
-  _LOG.debug('Wrote metrics to db interface, got back model obj:%s', emo_model)
+  _emotion_metrics_buffer.add(emo_model)
+  _LOG.debug('Queued metrics in db interface, got back model obj:%s', emo_model)
   return emo_model
 
 
+def flush_emotion_metrics():
+  """Writes the buffered EmotionMetrics now, returns how many were written."""
+  return _emotion_metrics_buffer.flush()
+
+
+def flush_due_emotion_metrics():
+  """Writes the buffered EmotionMetrics that have waited long enough.
+
+  Only does anything on instances without a background writer, where requests
+  have to write the buffer themselves. Returns how many were written.
+  """
+  return _emotion_metrics_buffer.flush_due()
+
+
 def query_emotion_metrics(episode_id=None,
                           sample_id=None,
                           user_id=None,
@@ -80,33 +105,75 @@ def query_one_svg(image_class=None, model_description=None):
     model_description: A string description of the model that created the sketch
       like 'real_data' or 'vanilla_sketch_rnn'.
   Returns:
-    The first image model returned by the query, prioritizing recently created
-    images that have never been viewed.
+    One of the least viewed images, prioritizing recently created images that
+    have never been viewed. Concurrent calls get different images of the
+    prefetched candidates in turn.
   """
-  results = models.SketchImage.Get(
-      image_class=image_class, model_description=model_description, count=1)
-  if results:
-    return results[0]
-  else:
+  result = _sketch_pool.next(
+      image_class=image_class, model_description=model_description)
+  if result is None:
     _LOG.debug('No images to display! using example')
-    return None
+  return result
 
 
 def update_sketch_times_viewed(svg_id):
   """Increment the number of times a sketch model has been viewed based on key.
 
+  The view goes to a shard of the sketch's view counter, and reaches its
+  times_viewed with the next roll_up_sketch_views.
+
   Args:
     svg_id: An integer key of the sketch instance.
+  Returns:
+    The sketch model with times_viewed counting this view, but not the views
+    of other requests that were not rolled up yet, or None if there is no such
+    sketch.
   """
-  try:
-    sketch_model = models.SketchImage.get_by_id(int(svg_id))
-
-    sketch_model.times_viewed += 1
-    sketch_model.put()
-    _LOG.info('Updated sketch of class %s so that the times viewed are now %i',
-              sketch_model.image_class, sketch_model.times_viewed)
-  except:  # pylint: disable=bare-except
+  sketch_model = models.SketchImage.get_by_id(int(svg_id))
+  if sketch_model is None:
     _LOG.error('Such a sketch does not exist.')
+    return None
+
+  increment_sketch_views({int(svg_id): 1})
+  # Reading the shards would cost a get of every one of them per view.
+  sketch_model.times_viewed += 1
+  _LOG.info('Updated sketch of class %s so that the times viewed are now %i',
+            sketch_model.image_class, sketch_model.times_viewed)
+  return sketch_model
+
+
+def increment_sketch_views(view_counts):
+  """Counts views of several sketches at once.
+
+  Args:
+    view_counts: A dictionary with integer sketch IDs as keys and the number of
+      views to add as values.
+  """
+  models.SketchViewShard.Increment(
+      dict((svg_id, count) for svg_id, count in view_counts.iteritems()
+           if count > 0))
+
+
+def roll_up_sketch_views():
+  """Moves the sharded views of every sketch into its times_viewed.
+
+  A sketch whose roll up fails, like when its transaction keeps contending
+  with new views, keeps its shards for the next run and does not stop the
+  others.
+
+  Returns:
+    The number of views moved.
+  """
+  views = 0
+  failed = 0
+  for svg_id in models.SketchViewShard.PendingSketchIds():
+    try:
+      views += models.SketchViewShard.RollUp(svg_id)
+    except datastore_errors.Error:
+      _LOG.exception('Rolling up the views of sketch %i failed.', svg_id)
+      failed += 1
+  _LOG.info('Rolled up %i sketch views, %i sketches failed', views, failed)
+  return views
 
 
 def add_example_image():
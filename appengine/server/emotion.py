@@ -4,13 +4,108 @@ This code stores no personally identifiable information and our intent is that
 no derived code will do so.
 """
 
-from googleapiclient.discovery import build
+import contextlib
+import json
+import os
+import Queue
+import threading
+import time
+
+import frame_cache
+import httplib2
+from googleapiclient.discovery import build_from_document
 
 # TODO(douglaseck): Refector to use valid key and hide it properly.
 API_KEY = 'Akey'
 
+# Discovery document of the Vision API, bundled so that clients are built
+# without fetching it.
+DISCOVERY_DOC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'visionapi.json')
+# Environment variable pointing the clients at another server, like a local
+# stand-in for tests.
+ROOT_URL_ENV = 'VISION_API_ROOT_URL'
+CLIENT_POOL_SIZE = 4
+HTTP_TIMEOUT_SECONDS = 30
+# The Vision API accepts at most 16 images per annotate call.
+MAX_BATCH_SIZE = 16
+# How long a batch waits for frames of concurrent requests before it is sent.
+LINGER_SECONDS = 0.02
+# How long a request waits for the annotate calls of its frames, a batch
+# collected by another request may be a call ahead of its own.
+WAIT_TIMEOUT_SECONDS = 45
+
+
+class VisionClientPool(object):
+  """Vision API clients built once and reused, each keeping its connection.
+
+  httplib2 connections are not thread safe, so a request borrows a client for
+  the duration of its call. Clients are built on demand, up to size of them.
+  """
+
+  def __init__(self, discovery_doc=DISCOVERY_DOC, root_url=None,
+               size=CLIENT_POOL_SIZE, developer_key=API_KEY):
+    """Reads the discovery document.
+
+    Args:
+      discovery_doc: Path of the Vision API discovery document.
+      root_url: Root URL of the Vision API, defaults to the one of the
+        discovery document unless VISION_API_ROOT_URL is set.
+      size: The maximum number of clients.
+      developer_key: The API key sent with every request.
+    """
+    with open(discovery_doc) as infile:
+      self._document = json.load(infile)
+    root_url = root_url or os.environ.get(ROOT_URL_ENV)
+    if root_url:
+      self._document['rootUrl'] = root_url.rstrip('/') + '/'
+      self._document['baseUrl'] = (self._document['rootUrl'] +
+                                   self._document['servicePath'])
+    self._developer_key = developer_key
+    self._idle = Queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(size)
+
+  def _build(self):
+    return build_from_document(
+        self._document,
+        http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS),
+        developerKey=self._developer_key)
+
+  @contextlib.contextmanager
+  def client(self):
+    """Lends a client, waiting while all of them are in use."""
+    self._slots.acquire()
+    try:
+      try:
+        service = self._idle.get_nowait()
+      except Queue.Empty:
+        service = self._build()
+      yield service
+      # A client whose call failed is dropped, its connection may be broken.
+      self._idle.put(service)
+    finally:
+      self._slots.release()
+
+
+_client_pool = None
+_client_pool_lock = threading.Lock()
+
+
+def get_client_pool():
+  """Returns the process-wide VisionClientPool, creating it on first use."""
+  global _client_pool
+  with _client_pool_lock:
+    if _client_pool is None:
+      _client_pool = VisionClientPool()
+    return _client_pool
+
 def build_json(image_content):
   """Builds a json string containing response from vision api."""
+  return build_batch_json([image_content])
+
+
+def build_batch_json(image_contents):
+  """Builds the json body of an annotate call for several images."""
   json_data = {
       'requests': [{
           'image': {
@@ -20,7 +115,7 @@ def build_json(image_content):
               'type': 'FACE_DETECTION',
               'maxResults': 1,
           }]
-      }]
+      } for image_content in image_contents]
   }
   return json_data
 
@@ -43,18 +138,202 @@ def emotion_likelihoods(response):
   """Returns list of tuples containing [name, likelihood] for all emotions."""
   emotion_list = []
   for image_annotation in response['responses']:
-    if 'faceAnnotations' in image_annotation:
-      # We only parse the first face annotation.
-      for label, bin_name in image_annotation['faceAnnotations'][0].iteritems():
-        if label in LIKELIHOOD_LABELS:
-          name = label.replace('Likelihood', '')
-          emotion_list.append([name, BIN_VALUES[bin_name]])
+    emotion_list.extend(face_likelihoods(image_annotation))
+  return emotion_list
+
+
+def face_likelihoods(image_annotation):
+  """Returns the [name, likelihood] emotions of the annotation of one image."""
+  emotion_list = []
+  if 'faceAnnotations' in image_annotation:
+    # We only parse the first face annotation.
+    for label, bin_name in image_annotation['faceAnnotations'][0].iteritems():
+      if label in LIKELIHOOD_LABELS:
+        name = label.replace('Likelihood', '')
+        emotion_list.append([name, BIN_VALUES[bin_name]])
   return emotion_list
 
 
 def annotate_image(image_content):
   json_data = build_json(image_content)
-  service = build('vision', 'v1', developerKey=API_KEY)
-  request = service.images().annotate(body=json_data)
-  response = request.execute()
+  with get_client_pool().client() as service:
+    response = service.images().annotate(body=json_data).execute()
   return emotion_likelihoods(response)
+
+
+def annotate_images(image_contents):
+  """Annotates several images with one call per MAX_BATCH_SIZE of them.
+
+  Args:
+    image_contents: A list of base64 encoded images.
+  Returns:
+    A list holding the [name, likelihood] emotions of every image.
+  """
+  emotion_lists = []
+  for start in range(0, len(image_contents), MAX_BATCH_SIZE):
+    json_data = build_batch_json(image_contents[start:start + MAX_BATCH_SIZE])
+    with get_client_pool().client() as service:
+      response = service.images().annotate(body=json_data).execute()
+    emotion_lists.extend(face_likelihoods(image_annotation)
+                         for image_annotation in response['responses'])
+  return emotion_lists
+
+
+class _Frame(object):
+  """A frame waiting in an AnnotateBatcher."""
+
+  def __init__(self, image_content):
+    self.image_content = image_content
+    self.emotion_list = None
+    self.error = None
+    self.done = False
+
+
+class AnnotateBatcher(object):
+  """Combines the frames of concurrent requests into shared annotate calls.
+
+  The first request to find frames waiting collects a batch: while other
+  requests are annotating too, it lingers until max_batch_size frames are
+  waiting or linger_seconds have passed, and sends them in one call while the
+  other requests wait for their results. Requests with frames left over take
+  turns collecting the following batches.
+  """
+
+  def __init__(self, max_batch_size=MAX_BATCH_SIZE,
+               linger_seconds=LINGER_SECONDS,
+               wait_timeout_seconds=WAIT_TIMEOUT_SECONDS,
+               annotate=annotate_images):
+    """Creates an empty batcher.
+
+    Args:
+      max_batch_size: The maximum number of frames sent in one call.
+      linger_seconds: How long a batch waits for more frames.
+      wait_timeout_seconds: How long a request waits for its frames.
+      annotate: Function annotating a list of images, see annotate_images.
+    """
+    self._max_batch_size = max_batch_size
+    self._linger_seconds = linger_seconds
+    self._wait_timeout_seconds = wait_timeout_seconds
+    self._annotate = annotate
+    self._condition = threading.Condition()
+    self._pending = []
+    self._collecting = False
+    # The number of requests in annotate.
+    self._active = 0
+
+  def _collect(self):
+    """Takes the next batch of pending frames, called holding the lock."""
+    self._collecting = True
+    try:
+      # Without concurrent requests there are no frames to linger for.
+      if self._active > 1:
+        deadline = time.time() + self._linger_seconds
+        while len(self._pending) < self._max_batch_size:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            break
+          self._condition.wait(remaining)
+      batch = self._pending[:self._max_batch_size]
+      del self._pending[:self._max_batch_size]
+    finally:
+      self._collecting = False
+      # Lets a request with frames still pending collect the next batch.
+      self._condition.notify_all()
+    return batch
+
+  def _send(self, batch):
+    try:
+      emotion_lists = self._annotate([frame.image_content for frame in batch])
+      for frame, emotion_list in zip(batch, emotion_lists):
+        frame.emotion_list = emotion_list
+    except Exception as e:  # pylint: disable=broad-except
+      for frame in batch:
+        frame.error = e
+    finally:
+      # Also when the call was interrupted, like by a DeadlineExceededError,
+      # so the requests waiting for the frames do not wait forever.
+      with self._condition:
+        for frame in batch:
+          if frame.emotion_list is None and frame.error is None:
+            frame.error = RuntimeError('The annotate call was interrupted.')
+          frame.done = True
+        self._condition.notify_all()
+
+  def annotate(self, image_contents):
+    """Annotates the images, sharing calls with concurrent requests.
+
+    Args:
+      image_contents: A list of base64 encoded images.
+    Returns:
+      A list holding the [name, likelihood] emotions of every image.
+    Raises:
+      Exception: The error of a failed annotate call of one of the images.
+      RuntimeError: The images were not annotated within wait_timeout_seconds.
+    """
+    frames = [_Frame(image_content) for image_content in image_contents]
+    deadline = time.time() + self._wait_timeout_seconds
+    with self._condition:
+      self._pending.extend(frames)
+      self._active += 1
+      self._condition.notify_all()
+    try:
+      while True:
+        with self._condition:
+          if all(frame.done for frame in frames):
+            break
+          if self._collecting or not any(
+              frame in self._pending for frame in frames):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+              raise RuntimeError('Timed out waiting for the annotate calls.')
+            self._condition.wait(remaining)
+            continue
+          batch = self._collect()
+        self._send(batch)
+    finally:
+      with self._condition:
+        self._active -= 1
+        # Frames nobody waits for any more are not sent.
+        self._pending = [frame for frame in self._pending
+                         if frame not in frames]
+
+    for frame in frames:
+      if frame.error is not None:
+        raise frame.error
+    return [frame.emotion_list for frame in frames]
+
+
+_batcher = AnnotateBatcher()
+_cache = frame_cache.FrameCache()
+
+
+def annotate_frames(image_contents, user_ids):
+  """Annotates the images with the process-wide AnnotateBatcher.
+
+  Frames that are nearly identical to a recently annotated frame of the same
+  user reuse its emotions, only the others are sent to the Vision API.
+
+  Args:
+    image_contents: A list of base64 encoded images.
+    user_ids: The ID of the user of every image, frames without one are not
+      cached.
+  Returns:
+    A list holding the [name, likelihood] emotions of every image.
+  """
+  hashes = [frame_cache.frame_hash(image_content)
+            for image_content in image_contents]
+  emotion_lists = [_cache.lookup(user_id, value)
+                   for user_id, value in zip(user_ids, hashes)]
+  missing = [i for i, emotion_list in enumerate(emotion_lists)
+             if emotion_list is None]
+  if missing:
+    annotated = _batcher.annotate([image_contents[i] for i in missing])
+    for i, emotion_list in zip(missing, annotated):
+      emotion_lists[i] = emotion_list
+      _cache.store(user_ids[i], hashes[i], emotion_list)
+  return emotion_lists
+
+
+def frame_cache_stats():
+  """Returns hits, misses, hit rate and size of the process-wide frame cache."""
+  return _cache.stats()
@@ -0,0 +1,108 @@
+"""Streaming export of EmotionMetrics, one page of a cursor at a time.
+
+Pages are read with projection queries (see index.yaml) and turned into
+columns, so memory use only depends on the page size, however large the
+experiment. The pages can be written as CSV or as numbered .npz chunks of
+NumPy arrays, for example from a remote_api shell:
+
+  import export
+  export.write_npz_chunks(export.iter_pages('my_experiment'), 'my_experiment')
+
+experiment_description is not exported, it is not indexed and so can not be
+projected.
+"""
+
+import calendar
+import csv
+import os
+
+from google.appengine.datastore.datastore_query import Cursor
+import models
+
+EXPORT_FIELDS = ('user_id', 'episode_id', 'sample_id', 'timestamp',
+                 'time_since_sample_displayed', 'joy', 'sorrow', 'surprise',
+                 'anger')
+PAGE_SIZE = 500
+
+
+def iter_pages(experiment_name=None, page_size=PAGE_SIZE, cursor=None):
+  """Yields the pages of an export.
+
+  Args:
+    experiment_name: String name of the experiment to export, all metrics
+      when None.
+    page_size: The number of metrics of a page.
+    cursor: The urlsafe cursor of a page to resume from, None starts at the
+      oldest metrics.
+  Yields:
+    (columns, cursor) pairs, with a dictionary of one list per field of
+    EXPORT_FIELDS, and the urlsafe cursor of the next page, None after the
+    last one.
+  """
+  query = models.EmotionMetrics.ExportQuery(experiment_name)
+  start_cursor = Cursor(urlsafe=cursor) if cursor else None
+  while True:
+    entities, next_cursor, more = query.fetch_page(
+        page_size, start_cursor=start_cursor, projection=EXPORT_FIELDS)
+    columns = dict((field, [getattr(entity, field) for entity in entities])
+                   for field in EXPORT_FIELDS)
+    more = more and next_cursor is not None
+    yield columns, next_cursor.urlsafe() if more else None
+    if not more:
+      return
+    start_cursor = next_cursor
+
+
+def _timestamp_seconds(timestamp):
+  return calendar.timegm(timestamp.timetuple()) + timestamp.microsecond * 1e-6
+
+
+def write_csv(pages, outfile, header=True):
+  """Writes pages of iter_pages as CSV rows, returns the number of rows."""
+  writer = csv.writer(outfile)
+  if header:
+    writer.writerow(EXPORT_FIELDS)
+  rows = 0
+  for columns, _ in pages:
+    columns = dict(columns)
+    columns['timestamp'] = [timestamp.isoformat()
+                            for timestamp in columns['timestamp']]
+    page = zip(*[columns[field] for field in EXPORT_FIELDS])
+    writer.writerows(page)
+    rows += len(page)
+  return rows
+
+
+def write_npz_chunks(pages, directory):
+  """Writes every page of iter_pages to a numbered .npz file of columns.
+
+  Timestamps are stored as float seconds since the epoch and missing values
+  as NaN. Every chunk also holds the cursor of the next page, to resume an
+  interrupted export.
+
+  Args:
+    pages: The pages of iter_pages.
+    directory: Directory of the chunk files, created if missing.
+  Returns:
+    The number of chunks written.
+  """
+  import numpy as np  # pylint: disable=g-import-not-at-top
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  chunks = 0
+  for columns, cursor in pages:
+    arrays = {
+        'user_id': np.array(columns['user_id'], dtype=np.float64),
+        'episode_id': np.array(columns['episode_id'], dtype=np.float64),
+        'sample_id': np.array(columns['sample_id'], dtype=np.float64),
+        'timestamp': np.array([_timestamp_seconds(timestamp)
+                               for timestamp in columns['timestamp']]),
+    }
+    for field in ('time_since_sample_displayed', 'joy', 'sorrow', 'surprise',
+                  'anger'):
+      arrays[field] = np.array(columns[field], dtype=np.float64)
+    arrays['next_cursor'] = np.array(cursor or '')
+    np.savez(os.path.join(directory, 'emotion_metrics_%05i.npz' % chunks),
+             **arrays)
+    chunks += 1
+  return chunks
@@ -0,0 +1,121 @@
+"""Cache of emotion results for near-identical webcam frames.
+
+Consecutive frames of a still viewer barely differ, so the emotions detected
+in a frame are reused for frames of the same viewer whose perceptual hash is
+within a few bits of it. Only the user IDs, the 64 bit hashes and the detected
+emotions are kept, in memory and for a few seconds; no image is stored.
+"""
+
+import base64
+import collections
+import io
+import logging
+import threading
+import time
+
+_LOG = logging
+
+CACHE_SIZE = 1024
+TTL_SECONDS = 5.0
+# Frames whose hashes differ in at most this many of their 64 bits are
+# considered the same, 0 only reuses the results of identical hashes.
+MAX_HAMMING_DISTANCE = 4
+
+
+def frame_hash(image_content):
+  """Computes the difference hash (dHash) of a frame.
+
+  Args:
+    image_content: A base64 encoded JPEG image.
+  Returns:
+    A 64 bit integer, or None if the image could not be decoded.
+  """
+  from PIL import Image  # pylint: disable=g-import-not-at-top
+  try:
+    image = Image.open(io.BytesIO(base64.b64decode(image_content)))
+    resample = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+    pixels = list(image.convert('L').resize((9, 8), resample).getdata())
+  except Exception:  # pylint: disable=broad-except
+    _LOG.warning('Could not hash a frame, it will not be cached.')
+    return None
+  value = 0
+  for row in range(8):
+    for column in range(8):
+      left, right = pixels[row * 9 + column], pixels[row * 9 + column + 1]
+      value = (value << 1) | (left > right)
+  return value
+
+
+class FrameCache(object):
+  """LRU cache of emotion lists keyed by user and perceptual hash of frames.
+
+  Entries expire ttl_seconds after they were stored. A lookup matches the
+  most recently used entry of the same user within max_distance bits of the
+  hash, so the results of a viewer are never served to another one.
+  """
+
+  def __init__(self, size=CACHE_SIZE, ttl_seconds=TTL_SECONDS,
+               max_distance=MAX_HAMMING_DISTANCE):
+    self._size = size
+    self._ttl_seconds = ttl_seconds
+    self._max_distance = max_distance
+    self._lock = threading.Lock()
+    # (user ID, hash) to (time stored, emotion list), least recently used
+    # first.
+    self._entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def _expire(self, now):
+    expired = [key for key, (stored, _) in self._entries.iteritems()
+               if now - stored > self._ttl_seconds]
+    for key in expired:
+      del self._entries[key]
+
+  def _match(self, user_id, value):
+    if (user_id, value) in self._entries:
+      return user_id, value
+    if not self._max_distance:
+      return None
+    for key in reversed(self._entries):
+      if (key[0] == user_id and
+          bin(key[1] ^ value).count('1') <= self._max_distance):
+        return key
+    return None
+
+  def lookup(self, user_id, value):
+    """Returns the emotion list of a similar recent frame of the user, or None.
+
+    Args:
+      user_id: The ID of the user the frame comes from, None is always a miss.
+      value: The frame_hash of the frame, None is always a miss.
+    """
+    with self._lock:
+      key = None
+      if user_id is not None and value is not None:
+        self._expire(time.time())
+        key = self._match(user_id, value)
+      if key is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      # Mark the entry as recently used.
+      entry = self._entries.pop(key)
+      self._entries[key] = entry
+      return entry[1]
+
+  def store(self, user_id, value, emotion_list):
+    if user_id is None or value is None:
+      return
+    with self._lock:
+      self._entries.pop((user_id, value), None)
+      self._entries[(user_id, value)] = (time.time(), emotion_list)
+      while len(self._entries) > self._size:
+        self._entries.popitem(last=False)
+
+  def stats(self):
+    """Returns hits, misses, hit rate and number of entries of the cache."""
+    with self._lock:
+      lookups = self.hits + self.misses
+      hit_rate = float(self.hits) / lookups if lookups else 0.0
+      return self.hits, self.misses, hit_rate, len(self._entries)
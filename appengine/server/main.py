@@ -37,6 +37,22 @@ class EmotionDetectorResponse(messages.Message):
   face_count = messages.IntegerField(3)
 
 
+class EmotionDetectorBatchRequest(messages.Message):
+  frames = messages.MessageField(EmotionDetectorRequest, 1, repeated=True)
+
+
+class EmotionDetectorBatchResponse(messages.Message):
+  # One response per frame, in the order of the request.
+  responses = messages.MessageField(EmotionDetectorResponse, 1, repeated=True)
+
+
+class FrameCacheStatsResponse(messages.Message):
+  hits = messages.IntegerField(1)
+  misses = messages.IntegerField(2)
+  hit_rate = messages.FloatField(3)
+  entries = messages.IntegerField(4)
+
+
 class GetSvgResponse(messages.Message):
   # Content is an Svg image encoded in a string.
   svg_image = messages.StringField(1)
@@ -57,6 +73,22 @@ GET_SVG_RESOURCE = endpoints.ResourceContainer(
     image_class=messages.StringField(1, default=None))
 
 
+def _image_content(frame):
+  # Request image comes in as a dataurl.
+  return re.sub('^data:image/jpeg;base64,', '', frame.image)
+
+
+def _emotion_detector_response(emotion_list, episode):
+  response = EmotionDetectorResponse()
+  for (name, confidence) in emotion_list:
+    response.emotion_metrics.append(
+        EmotionMetric(name=name, confidence=confidence))
+
+  response.face_count = 1 if emotion_list else 0
+  response.episode = episode
+  return response
+
+
 @endpoints.api(name='affective', version='v1', api_key_required=True)
 class AffectiveApi(remote.Service):
   """Affective API endpoint service."""
@@ -69,19 +101,40 @@ class AffectiveApi(remote.Service):
 
   def emotion_detector(self, request):
     """Call public cloud emotion detector."""
-    # Request image comes in as a dataurl.
-    image_data = re.sub('^data:image/jpeg;base64,', '', request.image)
-    emotion_list = emotion.annotate_image(image_data)
-    response = EmotionDetectorResponse()
-    for (name, confidence) in emotion_list:
-      response.emotion_metrics.append(
-          EmotionMetric(name=name, confidence=confidence))
-
-    response.face_count = 1 if emotion_list else 0
-    response.episode = request.episode
+    # Frames of concurrent requests share annotate calls.
+    emotion_list, = emotion.annotate_frames([_image_content(request)],
+                                            [request.user_id])
+    return _emotion_detector_response(emotion_list, request.episode)
 
+  @endpoints.method(
+      EmotionDetectorBatchRequest,
+      EmotionDetectorBatchResponse,
+      path='emotion_detector_batch',
+      http_method='POST',
+      name='emotion_detector_batch')
+  def emotion_detector_batch(self, request):
+    """Call public cloud emotion detector for several frames at once."""
+    emotion_lists = emotion.annotate_frames(
+        [_image_content(frame) for frame in request.frames],
+        [frame.user_id for frame in request.frames])
+    response = EmotionDetectorBatchResponse()
+    for frame, emotion_list in zip(request.frames, emotion_lists):
+      response.responses.append(
+          _emotion_detector_response(emotion_list, frame.episode))
     return response
 
+  @endpoints.method(
+      message_types.VoidMessage,
+      FrameCacheStatsResponse,
+      path='frame_cache_stats',
+      http_method='GET',
+      name='frame_cache_stats')
+  def frame_cache_stats(self, request):
+    """Hit rate of the frame cache of this instance."""
+    hits, misses, hit_rate, entries = emotion.frame_cache_stats()
+    return FrameCacheStatsResponse(
+        hits=hits, misses=misses, hit_rate=hit_rate, entries=entries)
+
   @endpoints.method(
       GET_SVG_RESOURCE,
       GetSvgResponse,
@@ -89,7 +142,8 @@ class AffectiveApi(remote.Service):
       http_method='GET',
       name='get_svg')
   def get_svg(self, request):
-    svg_model = db_interface.query_one_svg()
+    db_interface.flush_due_emotion_metrics()
+    svg_model = db_interface.query_one_svg(image_class=request.image_class)
     svg_image = ''
     svg_id = 0
     if svg_model:
@@ -114,12 +168,13 @@ class AffectiveApi(remote.Service):
       http_method='GET',
       name='increment_sketch_view_count')
   def increment_sketch_view_count(self, request):
+    db_interface.flush_due_emotion_metrics()
     response = IncrementSketchViewCountResponse()
     if request.svg_id:
       response.svg_id = request.svg_id
       sample_model = db_interface.update_sketch_times_viewed(request.svg_id)
       if sample_model:
-        response.times_viewed = sample_model.times_viewed,
+        response.times_viewed = sample_model.times_viewed
 
     return response
 
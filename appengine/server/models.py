@@ -1,5 +1,8 @@
 """Defines datastore database models.
 """
+import datetime
+import random
+
 from google.appengine.ext import ndb
 
 _DEFAULT_FETCH_SIZE = 128
@@ -36,18 +39,29 @@ class EmotionMetrics(ndb.Model):
   anger = ndb.FloatProperty()
 
   @classmethod
-  def CreateAndStore(cls,
-                     user_id,
-                     episode_id,
-                     sample_id,
-                     joy,
-                     sorrow,
-                     surprise,
-                     anger,
-                     time_elapsed,
-                     experiment_name='',
-                     experiment_description=''):
-    """Creates and stores an EmotionMetrics entity for this user and sample.
+  def CreateAndStore(cls, *args, **kwargs):
+    """Creates and stores an EmotionMetrics entity, see Create for the args.
+
+    Returns:
+      The created and stored EmotionMetrics entity.
+    """
+    emo_metrics = cls.Create(*args, **kwargs)
+    emo_metrics.put()
+    return emo_metrics
+
+  @classmethod
+  def Create(cls,
+             user_id,
+             episode_id,
+             sample_id,
+             joy,
+             sorrow,
+             surprise,
+             anger,
+             time_elapsed,
+             experiment_name='',
+             experiment_description=''):
+    """Creates an EmotionMetrics entity for this user and sample, unsaved.
 
     Args:
       user_id: An integer hashed / anonymized user ID.
@@ -64,9 +78,11 @@ class EmotionMetrics(ndb.Model):
       experiment_description: Long form text describing the experiment.
 
     Returns:
-      Created and stored Woof entity.
+      The EmotionMetrics entity, without a key until it is put.
     """
-    emo_metrics = cls(
+    return cls(
+        # Set now rather than when the entity is written, which may be later.
+        timestamp=datetime.datetime.utcnow(),
         user_id=user_id,
         episode_id=episode_id,
         sample_id=sample_id,
@@ -77,8 +93,6 @@ class EmotionMetrics(ndb.Model):
         time_since_sample_displayed=time_elapsed,
         experiment_name=experiment_name,
         experiment_description=experiment_description)
-    emo_metrics.put()
-    return emo_metrics
 
   @classmethod
   def Get(cls,
@@ -113,6 +127,21 @@ class EmotionMetrics(ndb.Model):
     results = query.fetch(limit=count)
     return results
 
+  @classmethod
+  def ExportQuery(cls, experiment_name=None):
+    """Returns the query of an export, oldest metrics first.
+
+    Args:
+      experiment_name: String name of the experiment to export, all metrics
+        when None.
+    Returns:
+      An ndb query of EmotionMetrics models.
+    """
+    query = cls.query()
+    if experiment_name:
+      query = query.filter(cls.experiment_name == experiment_name)
+    return query.order(cls.timestamp)
+
 
 class SketchImage(ndb.Model):
   """Stores a sample sketch image in SVG format.
@@ -163,10 +192,100 @@ class SketchImage(ndb.Model):
     Returns:
       List of SketchImage model entities.
     """
+    return cls.Query(image_class, model_description).fetch(limit=count)
+
+  @classmethod
+  def Query(cls, image_class=None, model_description=None):
+    """Returns the query of Get, least viewed and most recent sketches first.
+
+    Args:
+      image_class: A string image class like 'cat'.
+      model_description: A string description of the model that created the
+        sketch like 'real_data' or 'vanilla_sketch_rnn'.
+    Returns:
+      An ndb query of SketchImage models.
+    """
     query = cls.query().order(cls.times_viewed).order(-cls.time_created)
     if image_class:
       query = query.filter(cls.image_class == image_class)
     if model_description:
       query = query.filter(cls.model_description == model_description)
-    results = query.fetch(limit=count)
-    return results
+    return query
+
+
+# Views of a sketch are spread over this many shards, so concurrent viewers
+# rarely write the same entity.
+NUM_VIEW_SHARDS = 20
+# Cross group transactions span at most 25 entity groups.
+_MAX_XG_GROUPS = 25
+
+
+class SketchViewShard(ndb.Model):
+  """Stores views of a sketch that are not part of its times_viewed yet.
+
+  The key name is '<svg_id>-<shard>'. RollUp moves the views of every shard
+  into SketchImage.times_viewed.
+
+  Properties:
+    svg_id: The integer ID of the viewed SketchImage.
+    count: The number of views not rolled up yet.
+  """
+  svg_id = ndb.IntegerProperty(indexed=False)
+  count = ndb.IntegerProperty(default=0)
+
+  @classmethod
+  def ShardKey(cls, svg_id, shard):
+    return ndb.Key(cls, '%i-%i' % (svg_id, shard))
+
+  @classmethod
+  def Increment(cls, view_counts):
+    """Adds views to random shards, in transactions of up to 25 shards.
+
+    Args:
+      view_counts: A dictionary with integer sketch IDs as keys and the number
+        of views to add as values.
+    """
+    keys = [(cls.ShardKey(svg_id, random.randint(0, NUM_VIEW_SHARDS - 1)),
+             svg_id, count) for svg_id, count in view_counts.iteritems()]
+
+    @ndb.transactional(xg=True)
+    def IncrementShards(batch):
+      shards = ndb.get_multi([key for key, _, _ in batch])
+      for i, (key, svg_id, count) in enumerate(batch):
+        if shards[i] is None:
+          shards[i] = cls(key=key, svg_id=svg_id)
+        shards[i].count += count
+      ndb.put_multi(shards)
+
+    for start in range(0, len(keys), _MAX_XG_GROUPS):
+      IncrementShards(keys[start:start + _MAX_XG_GROUPS])
+
+  @classmethod
+  def PendingSketchIds(cls):
+    """Returns the IDs of the sketches with views not rolled up yet."""
+    keys = cls.query(cls.count > 0).fetch(keys_only=True)
+    return sorted(set(int(key.id().split('-')[0]) for key in keys))
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def RollUp(cls, svg_id):
+    """Moves the views of every shard of a sketch into its times_viewed.
+
+    Args:
+      svg_id: The integer ID of the SketchImage.
+    Returns:
+      The number of views moved.
+    """
+    shards = [shard for shard in ndb.get_multi(
+        [cls.ShardKey(svg_id, shard) for shard in range(NUM_VIEW_SHARDS)])
+              if shard is not None and shard.count]
+    views = sum(shard.count for shard in shards)
+    sketch = SketchImage.get_by_id(svg_id)
+    if sketch is not None and views:
+      sketch.times_viewed += views
+      sketch.put()
+    # Views of a deleted sketch are dropped.
+    for shard in shards:
+      shard.count = 0
+    ndb.put_multi(shards)
+    return views
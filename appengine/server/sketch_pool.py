@@ -0,0 +1,125 @@
+"""Pool of the next sketches to show, so get_svg does not query every time.
+
+For every (image_class, model_description) the pool keeps the pool_size least
+viewed sketches and hands them out round robin, so concurrent viewers see
+different sketches. Once every candidate has been handed out, or the
+candidates are older than refresh_seconds, a background thread fetches the
+next ones with one asynchronous query per stale pool, while the old ones keep
+being served.
+"""
+
+import logging
+import threading
+import time
+
+import models
+
+_LOG = logging
+
+POOL_SIZE = 20
+# The view counts of the sketches are rolled up every minute, see cron.yaml.
+REFRESH_SECONDS = 60.0
+
+
+class SketchCandidatePool(object):
+  """Hands out prefetched SketchImage candidates round robin."""
+
+  def __init__(self, pool_size=POOL_SIZE, refresh_seconds=REFRESH_SECONDS,
+               query=models.SketchImage.Query):
+    """Creates an empty pool, candidates are fetched on first use.
+
+    Args:
+      pool_size: The number of candidates fetched for every pool.
+      refresh_seconds: How long candidates are served before they are
+        fetched again.
+      query: Function returning the ndb query of the candidates of an
+        image_class and model_description.
+    """
+    self._pool_size = pool_size
+    self._refresh_seconds = refresh_seconds
+    self._query = query
+    self._condition = threading.Condition()
+    # (image_class, model_description) to its candidates, the position of the
+    # next one to hand out and the time they were fetched.
+    self._candidates = {}
+    self._positions = {}
+    self._fetched_at = {}
+    self._stale = set()
+    self._started = False
+    self._background = False
+
+  def _start(self):
+    with self._condition:
+      if self._started:
+        return
+      self._started = True
+    try:
+      # pylint: disable=g-import-not-at-top
+      from google.appengine.api import background_thread
+      # pylint: enable=g-import-not-at-top
+      background_thread.start_new_background_thread(self._run, [])
+      self._background = True
+    except Exception:  # pylint: disable=broad-except
+      # Instances without background threads refill on the request path.
+      _LOG.warning('No background thread for the sketch pool, refilling it '
+                   'on the request path instead.')
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while not self._stale:
+          self._condition.wait()
+        pools = list(self._stale)
+      try:
+        self._refill(pools)
+      except Exception:  # pylint: disable=broad-except
+        _LOG.exception('Refilling the sketch pool failed.')
+        time.sleep(1.0)
+
+  def _refill(self, pools):
+    """Fetches the candidates of the pools, with the queries in parallel.
+
+    The results bypass the in-context cache, which would otherwise keep every
+    candidate the never ending refill thread has fetched.
+    """
+    futures = [(pool, self._query(*pool).fetch_async(limit=self._pool_size,
+                                                     use_cache=False))
+               for pool in pools]
+    for pool, future in futures:
+      candidates = future.get_result()
+      with self._condition:
+        self._candidates[pool] = candidates
+        self._positions[pool] = 0
+        self._fetched_at[pool] = time.time()
+        self._stale.discard(pool)
+
+  def next(self, image_class=None, model_description=None):
+    """Returns the next candidate sketch, or None if there is none.
+
+    Args:
+      image_class: A string image class like 'cat'.
+      model_description: A string description of the model that created the
+        sketch like 'real_data' or 'vanilla_sketch_rnn'.
+    """
+    self._start()
+    pool = (image_class, model_description)
+    with self._condition:
+      fetched = pool in self._candidates
+    if not fetched:
+      # The first request of a pool waits for its candidates.
+      self._refill([pool])
+
+    with self._condition:
+      candidates = self._candidates[pool]
+      position = self._positions[pool]
+      self._positions[pool] = position + 1
+      stale = (time.time() - self._fetched_at[pool] > self._refresh_seconds or
+               0 < len(candidates) <= position + 1)
+      if stale and pool not in self._stale:
+        self._stale.add(pool)
+        self._condition.notify()
+    if stale and not self._background:
+      self._refill([pool])
+    if not candidates:
+      return None
+    return candidates[position % len(candidates)]
@@ -0,0 +1,42 @@
+"""Request handlers of the cron jobs listed in cron.yaml, and admin tasks."""
+
+import db_interface
+import export
+import webapp2
+
+
+class RollUpSketchViewsHandler(webapp2.RequestHandler):
+  """Moves the sharded view counts of the sketches into times_viewed."""
+
+  def get(self):
+    views = db_interface.roll_up_sketch_views()
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write('Rolled up %i views\n' % views)
+
+
+class ExportEmotionMetricsHandler(webapp2.RequestHandler):
+  """Answers one page of an EmotionMetrics export as CSV.
+
+  Takes experiment_name, cursor and page_size parameters. The cursor of the
+  next page is sent in the X-Next-Cursor header, which is missing after the
+  last page.
+  """
+
+  def get(self):
+    page_size = int(self.request.get('page_size', export.PAGE_SIZE))
+    pages = export.iter_pages(
+        experiment_name=self.request.get('experiment_name') or None,
+        page_size=min(page_size, 1000),
+        cursor=self.request.get('cursor') or None)
+    page = next(pages)
+    self.response.headers['Content-Type'] = 'text/csv'
+    if page[1]:
+      self.response.headers['X-Next-Cursor'] = page[1]
+    export.write_csv([page], self.response.out,
+                     header=not self.request.get('cursor'))
+
+
+app = webapp2.WSGIApplication([
+    ('/tasks/roll_up_sketch_views', RollUpSketchViewsHandler),
+    ('/tasks/export_emotion_metrics', ExportEmotionMetricsHandler),
+])
@@ -31,19 +31,14 @@ def convert_emotion_metric_entity_to_dict(e_metric):
     A dictionary with keys as emotions and values are confidences
   """
   e_dict = {}
-  e_dict['amusement'] = e_metric.amusement
-  e_dict['anger'] = e_metric.anger
-  e_dict['concentration'] = e_metric.concentration
-  e_dict['contentment'] = e_metric.contentment
-  e_dict['desire'] = e_metric.desire
-  e_dict['disappointment'] = e_metric.disappointment
-  e_dict['elation'] = e_metric.elation
-  e_dict['disgust'] = e_metric.disgust
-  e_dict['embarrassment'] = e_metric.embarrassment
-  e_dict['interest'] = e_metric.interest
-  e_dict['pride'] = e_metric.pride
-  e_dict['sadness'] = e_metric.sadness
+  e_dict['joy'] = e_metric.joy
+  e_dict['sorrow'] = e_metric.sorrow
   e_dict['surprise'] = e_metric.surprise
+  e_dict['anger'] = e_metric.anger
+  e_dict['user_id'] = e_metric.user_id
+  e_dict['episode_id'] = e_metric.episode_id
+  e_dict['sample_id'] = e_metric.sample_id
+  e_dict['timestamp'] = e_metric.timestamp
   e_dict['time_since_sample_displayed'] = e_metric.time_since_sample_displayed
   e_dict['experiment_name'] = e_metric.experiment_name
   e_dict['experiment_description'] = e_metric.experiment_description
@@ -58,19 +53,10 @@ def get_example_emotion_dict():
     A dictionary with keys as emotions and values are confidences
   """
   e_dict = {}
-  e_dict['amusement'] = 1.0
-  e_dict['anger'] = 0.0
-  e_dict['concentration'] = 0.0
-  e_dict['contentment'] = 0.8
-  e_dict['desire'] = 0.0
-  e_dict['disappointment'] = 0.2
-  e_dict['elation'] = 0.5
-  e_dict['disgust'] = 0.1
-  e_dict['embarrassment'] = 0.2
-  e_dict['interest'] = 0.3
-  e_dict['pride'] = 0.2
-  e_dict['sadness'] = 0.1
+  e_dict['joy'] = 1.0
+  e_dict['sorrow'] = 0.1
   e_dict['surprise'] = 0.4
+  e_dict['anger'] = 0.0
   e_dict['time_since_sample_displayed'] = 0
   e_dict['experiment_name'] = 'test_data'
   e_dict['experiment_description'] = 'Fake data, do not use.'
@@ -0,0 +1,146 @@
+"""Write-behind buffer batching datastore puts off the request path.
+
+Requests only add entities to the buffer. A background thread writes them
+with one ndb.put_multi per batch, as soon as max_batch_size entities are
+waiting or the oldest one has waited max_age_seconds, and once more when the
+instance shuts down. The puts bypass the ndb caches: the writer never leaves
+its context, so its in-context cache would otherwise keep every entity it
+ever wrote.
+
+On instances without background threads the requests write the batches
+themselves, either when they add an entity or, through flush_due, when they
+find the oldest one has waited long enough.
+"""
+
+import logging
+import threading
+import time
+
+from google.appengine.ext import ndb
+
+_LOG = logging
+
+MAX_BATCH_SIZE = 100
+MAX_AGE_SECONDS = 2.0
+# Entities kept while the datastore is failing, the oldest are dropped first.
+MAX_PENDING = 10000
+
+
+class WriteBehindBuffer(object):
+  """Buffers entities and writes them with batched multi-entity puts."""
+
+  def __init__(self, max_batch_size=MAX_BATCH_SIZE,
+               max_age_seconds=MAX_AGE_SECONDS, max_pending=MAX_PENDING,
+               put_multi=None):
+    """Creates an empty buffer, the writer starts with the first entity.
+
+    Args:
+      max_batch_size: The number of entities written by one put_multi.
+      max_age_seconds: How long an entity may wait before it is written.
+      max_pending: The maximum number of entities waiting to be written.
+      put_multi: Function writing a list of entities, ndb.put_multi without
+        caching by default.
+    """
+    self._max_batch_size = max_batch_size
+    self._max_age_seconds = max_age_seconds
+    self._max_pending = max_pending
+    self._put_multi = put_multi or (lambda batch: ndb.put_multi(
+        batch, use_cache=False, use_memcache=False))
+    self._condition = threading.Condition()
+    self._flush_lock = threading.Lock()
+    self._pending = []
+    self._oldest = None
+    # After a failed write, nothing is written before this time.
+    self._retry_at = 0
+    self._started = False
+    self._background = False
+
+  def add(self, entity):
+    """Queues an entity to be written."""
+    self._start()
+    with self._condition:
+      if not self._pending:
+        self._oldest = time.time()
+      self._pending.append(entity)
+      if len(self._pending) > self._max_pending:
+        del self._pending[0]
+        _LOG.error('Write-behind buffer is full, dropped an entity.')
+      due = self._due()
+      if due:
+        self._condition.notify()
+    if due and not self._background:
+      self.flush()
+
+  def flush_due(self):
+    """Writes the buffered entities if they are due and no thread writes them.
+
+    Returns:
+      The number of entities written.
+    """
+    self._start()
+    if self._background:
+      return 0
+    with self._condition:
+      due = self._due()
+    return self.flush() if due else 0
+
+  def _due(self):
+    now = time.time()
+    return bool(self._pending) and now >= self._retry_at and (
+        len(self._pending) >= self._max_batch_size or
+        now - self._oldest >= self._max_age_seconds)
+
+  def _start(self):
+    """Starts the writer thread and registers the shutdown flush."""
+    with self._condition:
+      if self._started:
+        return
+      self._started = True
+    try:
+      # pylint: disable=g-import-not-at-top
+      from google.appengine.api import background_thread
+      from google.appengine.api import runtime
+      # pylint: enable=g-import-not-at-top
+      runtime.set_shutdown_hook(lambda: self.flush())
+      background_thread.start_new_background_thread(self._run, [])
+      self._background = True
+    except Exception:  # pylint: disable=broad-except
+      # Instances without background threads write when a request finds
+      # the buffer due.
+      _LOG.warning('No background thread for the write-behind buffer, '
+                   'writing on the request path instead.')
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while not self._due():
+          wait = self._max_age_seconds
+          if self._pending:
+            wait = max(self._oldest + self._max_age_seconds, self._retry_at)
+            wait -= time.time()
+          self._condition.wait(max(wait, 0.01))
+      self.flush()
+
+  def flush(self):
+    """Writes every buffered entity, returns how many were written."""
+    written = 0
+    with self._flush_lock:
+      while True:
+        with self._condition:
+          batch = self._pending[:self._max_batch_size]
+          del self._pending[:self._max_batch_size]
+          self._oldest = time.time() if self._pending else None
+        if not batch:
+          return written
+        try:
+          self._put_multi(batch)
+        except Exception:  # pylint: disable=broad-except
+          # Keep the batch for the next flush.
+          _LOG.exception('Writing %i buffered entities failed.', len(batch))
+          with self._condition:
+            self._pending[:0] = batch
+            del self._pending[self._max_pending:]
+            self._oldest = time.time()
+            self._retry_at = self._oldest + self._max_age_seconds
+          return written
+        written += len(batch)
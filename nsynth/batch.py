@@ -0,0 +1,193 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Several grids generated together, for layouts that share most of their
+# instruments and pitches.
+#
+# The input samples are embedded once, for every grid. Each grid is then
+# interpolated in a working directory of its own (working_dir/grids/<name>),
+# and the embeddings of all grids go into a single generation queue where an
+# embedding made of the same instruments with the same weights at the same
+# pitch is generated only once. Its audio is linked into every grid that
+# needs it, and each grid is cleaned into output_grids/<name> with its own
+# options file.
+#
+#   python generate.py batch multigrid_4/settings.json multigrid_6/settings.json
+import json, os, shutil
+from os.path import isfile
+from pipeline import GridPipeline
+from supervisor import Chunk
+
+#  settings every grid of a batch has to agree on, since the embeddings are shared
+SHARED_SETTINGS = ('checkpoint_dir', 'final_length')
+
+
+class GridBatch(object):
+  """Generates several grids, sharing their embeddings and generation queue.
+
+  grids is a list of settings dicts, one per grid. The settings of the first
+  grid decide how the samples are embedded and how the audio is generated
+  (gpus, batch sizes, chunk_size, resident_decoder, ...). The directories
+  are the same as for GridPipeline and are shared by every grid.
+  """
+
+  def __init__(self, grids, root_dir='.', input_dir=None, working_dir=None, output_dir=None):
+    names = [settings['name'] for settings in grids]
+    if len(set(names)) != len(names):
+      raise ValueError("Every grid of a batch needs a name of its own, got %s" % ', '.join(names))
+    for key in SHARED_SETTINGS:
+      if len(set(json.dumps(settings.get(key)) for settings in grids)) > 1:
+        raise ValueError("Every grid of a batch needs the same %s" % key)
+    if any(settings.get('distributed', False) for settings in grids):
+      raise ValueError("Batches can not be generated on several hosts, generate the grids one at a time instead")
+
+    #  embeds the input samples and runs the shared generation queue
+    self.shared = GridPipeline(grids[0], root_dir, input_dir, working_dir, output_dir)
+    self.pipelines = [GridPipeline(settings, root_dir, input_dir,
+                                   self.shared.path('grids', settings['name']), output_dir,
+                                   embedding_dir=self.shared.embedding_dir) for settings in grids]
+    self.duplicates = {}
+
+  @classmethod
+  def from_settings_files(cls, settings_paths, **paths):
+    #  directories default to the ones next to the first settings file
+    grids = []
+    for settings_path in settings_paths:
+      with open(settings_path, 'r') as infile:
+        grids.append(json.load(infile))
+    paths.setdefault('root_dir', os.path.dirname(os.path.abspath(settings_paths[0])))
+    return cls(grids, **paths)
+
+  def compute_embeddings(self):
+    self.shared.compute_embeddings()
+    self.shared.correct_truncated_names()
+
+    #  fail before interpolating if a grid uses a sample that is not in audio_input
+    available = set('_'.join(fname.split('_')[:2]) for fname in os.listdir(self.shared.embedding_dir)
+                    if fname.endswith('.npy'))
+    for pipeline in self.pipelines:
+      settings = pipeline.settings
+      missing = sorted(set('{}_{}'.format(instrument, pitch) for row in settings['instruments']
+                           for instrument in row for pitch in settings['pitches']) - available)
+      if missing:
+        raise ValueError("Grid %s needs samples missing from the input: %s" % (settings['name'], ', '.join(missing)))
+
+  def interpolate_embeddings(self):
+    for pipeline in self.pipelines:
+      print("\nInterpolating grid %s" % pipeline.settings['name'])
+      pipeline.interpolate_embeddings()
+
+  def plan(self):
+    """Pools the unique embeddings of every grid.
+
+    Returns the names to generate, the grid each name belongs to, and the
+    (grid, name) copies in other grids that share the audio of each name.
+    """
+    groups = {}
+    for pipeline in self.pipelines:
+      index = pipeline.load_interp_index()
+      keys = dict(zip(pipeline.interp_names(index), pipeline.embedding_keys(index)))
+      for level, name in pipeline.unique_embeddings(index):
+        group = groups.setdefault(keys[name], [level, []])
+        group[0] = min(group[0], level)
+        group[1].append((pipeline, name))
+
+    #  the coarse levels of every grid first
+    owners, copies, pending = {}, {}, []
+    for level, members in sorted(groups.values(), key=lambda group: group[0]):
+      #  audio generated by an earlier run of any of the grids is reused
+      generated = [(pipeline, name) for pipeline, name in members if isfile(pipeline.generated_file(name))]
+      pipeline, name = generated[0] if generated else members[0]
+      owners[name] = pipeline
+      copies[name] = [member for member in members if member[1] != name]
+      if generated:
+        self.fan_out(name, owners, copies)
+      else:
+        pending.append(name)
+    return pending, owners, copies
+
+  def fan_out(self, name, owners, copies):
+    #  link the audio of a name into the rows of its own grid and the other grids sharing it
+    owner = owners[name]
+    linked = owner.fan_out(name, self.duplicates[owner])
+    for pipeline, copy in copies[name]:
+      if not isfile(pipeline.generated_file(copy)):
+        try:
+          os.link(owner.generated_file(name), pipeline.generated_file(copy))
+        except FileExistsError:
+          pass
+      linked.extend(pipeline.fan_out(copy, self.duplicates[pipeline]))
+    return linked
+
+  def finish_chunk(self, chunk, success, owners, copies):
+    source_path, save_path = self.shared.chunk_paths(chunk)
+    if success:
+      for name in chunk.names:
+        if isfile(os.path.join(save_path, 'gen_' + name + '.wav')):
+          os.replace(os.path.join(save_path, 'gen_' + name + '.wav'), owners[name].generated_file(name))
+          self.fan_out(name, owners, copies)
+    shutil.rmtree(source_path, ignore_errors=True)
+    shutil.rmtree(save_path, ignore_errors=True)
+
+  def generate(self):
+    for pipeline in self.pipelines:
+      os.makedirs(pipeline.path('audio', 'raw_wav'), exist_ok=True)
+    indexes = {pipeline: pipeline.load_interp_index() for pipeline in self.pipelines}
+    self.duplicates = {pipeline: pipeline.duplicate_names(index) for pipeline, index in indexes.items()}
+    rows = {pipeline: {name: row for row, name in enumerate(pipeline.interp_names(index))}
+            for pipeline, index in indexes.items()}
+
+    pending, owners, copies = self.plan()
+    print("Generating %i of the %i distinct embeddings of %i grids (%i without sharing between grids)" % (
+      len(pending), len(owners), len(self.pipelines), sum(1 + len(copies[name]) for name in owners)))
+    if not pending:
+      return
+
+    settings = self.shared.settings
+    chunk_size = settings.get('chunk_size') or settings['batch_size_generate']
+    chunks = [Chunk('%06d' % i, pending[start:start + chunk_size])
+              for i, start in enumerate(range(0, len(pending), chunk_size))]
+
+    def prepare(chunk, gpu):
+      source_path, save_path = self.shared.staging_paths(chunk)
+      for name in chunk.names:
+        owners[name].stage_embeddings([name], source_path, rows[owners[name]])
+      return self.shared.chunk_job(source_path, save_path, gpu)
+
+    finish = lambda chunk, success: self.finish_chunk(chunk, success, owners, copies)
+    is_done = lambda name: isfile(owners[name].generated_file(name))
+    print("Generate audio from embeddings (this may take a while!)\n")
+    try:
+      self.shared.supervise(chunks, prepare, finish, is_done)
+    except KeyboardInterrupt:
+      print("\nGeneration stopped, continuing with the samples generated so far")
+
+  def run(self):
+    print("\nComputing embeddings for the instruments of %i grids...\n" % len(self.pipelines))
+    self.compute_embeddings()
+
+    print("\nInterpolating embeddings between instruments at each pitch...")
+    self.interpolate_embeddings()
+
+    print("\nBatchings embeddings of every grid for GPU(s)...")
+    self.generate()
+
+    #  every grid is finished on its own, into output_grids/<name>
+    for pipeline in self.pipelines:
+      print("\nFinishing grid %s...\n" % pipeline.grid_name())
+      if pipeline.preview:
+        pipeline.derive_preview()
+      pipeline.clean_files()
+      pipeline.pack_output()
+      pipeline.generate_options_file()
@@ -0,0 +1,176 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks the CPU stages of generate.py on synthetic data, so regressions can
+# be caught without a checkpoint, real audio or a GPU.
+#
+# Random embeddings stand in for nsynth_save_embeddings and noise wavs stand in
+# for nsynth_generate. Every stage runs in a fresh process and reports its wall
+# time, files/sec, peak RSS and the bytes it added to the working directory.
+#
+#   python benchmark.py --grid_size 4 --resolution 9 --pitches 16
+import argparse, json, os, resource, shutil, subprocess, sys, tempfile, time
+import numpy as np
+import scipy.io.wavfile
+
+STAGES = ['interpolate', 'batch', 'clean', 'options']
+HOP_LENGTH = 512
+EMBEDDING_CHANNELS = 16
+
+
+def make_fixture(workdir, args):
+  instruments = [['inst%i%i' % (i, j) for j in range(args.grid_size)] for i in range(args.grid_size)]
+  pitches = [24 + 4 * i for i in range(args.pitches)]
+  settings = {
+    'instruments': instruments,
+    'checkpoint_dir': 'unused',
+    'pitches': pitches,
+    'resolution': args.resolution,
+    'final_length': args.final_length,
+    'gpus': 1,
+    'batch_size_embeddings': 32,
+    'batch_size_generate': args.batch_size_generate,
+    'name': 'benchmark',
+    'interp_storage': args.interp_storage,
+    'interp_dtype': args.interp_dtype,
+    'embedding_cache_dir': '',
+  }
+  if args.clean_workers:
+    settings['clean_workers'] = args.clean_workers
+  with open(os.path.join(workdir, 'settings.json'), 'w') as outfile:
+    json.dump(settings, outfile)
+
+  #  random embeddings in place of nsynth_save_embeddings
+  input_dir = os.path.join(workdir, 'working_dir/embeddings/input')
+  os.makedirs(input_dir)
+  rng = np.random.RandomState(0)
+  frames = args.final_length // HOP_LENGTH
+  for row in instruments:
+    for instrument in row:
+      for pitch in pitches:
+        embedding = rng.randn(frames, EMBEDDING_CHANNELS).astype(np.float32)
+        np.save(os.path.join(input_dir, '%s_%s_embeddings.npy' % (instrument, pitch)), embedding)
+
+
+def make_generated_audio(pipeline):
+  #  noise wavs in place of nsynth_generate, with the odd click to remove
+  rng = np.random.RandomState(0)
+  os.makedirs(pipeline.path('audio', 'raw_wav'), exist_ok=True)
+  names = pipeline.interp_names(pipeline.load_interp_index())
+  for name in names:
+    audio = 0.1 * rng.randn(pipeline.settings['final_length'])
+    audio[rng.randint(1, len(audio) - 1)] = 1.5
+    scipy.io.wavfile.write(pipeline.generated_file(name), 16000, (audio * 2**15 * 0.5).astype(np.int16))
+  return len(names)
+
+
+def run_stage(stage):
+  #  runs in a fresh process from inside the benchmark working directory
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  from pipeline import GridPipeline
+  pipeline = GridPipeline.from_settings_file('settings.json')
+
+  start = time.time()
+  if stage == 'interpolate':
+    pipeline.interpolate_embeddings()
+    files = len(pipeline.load_interp_index())
+  elif stage == 'batch':
+    files = sum(len(chunk.names) for chunk in pipeline.batch_embeddings())
+  elif stage == 'clean':
+    pipeline.clean_files()
+    files = len(os.listdir(pipeline.path('audio', 'raw_wav')))
+  elif stage == 'options':
+    pipeline.generate_options_file()
+    files = 1
+  elif stage == 'fixture_audio':
+    files = make_generated_audio(pipeline)
+  wall_time = time.time() - start
+
+  #  ru_maxrss is in kilobytes on Linux and bytes on macOS, worker pools count as children
+  peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  if sys.platform != 'darwin':
+    peak_rss *= 1024
+  print(json.dumps({'wall_time': wall_time, 'files': files, 'peak_rss': peak_rss}))
+
+
+def directory_size(path):
+  total = 0
+  for root, _, files in os.walk(path):
+    for fname in files:
+      fpath = os.path.join(root, fname)
+      if not os.path.islink(fpath):
+        total += os.path.getsize(fpath)
+  return total
+
+
+def benchmark_stage(workdir, stage):
+  size_before = directory_size(workdir)
+  output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run_stage', stage], cwd=workdir)
+  result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+  result['bytes_written'] = directory_size(workdir) - size_before
+  result['files_per_sec'] = result['files'] / result['wall_time'] if result['wall_time'] > 0 else None
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the stages of generate.py on synthetic data.')
+  parser.add_argument('--grid_size', type=int, default=2, help='instruments per side of the grid')
+  parser.add_argument('--resolution', type=int, default=5)
+  parser.add_argument('--pitches', type=int, default=4)
+  parser.add_argument('--final_length', type=int, default=64000)
+  parser.add_argument('--batch_size_generate', type=int, default=256)
+  parser.add_argument('--interp_storage', default='files', choices=['files', 'memmap'])
+  parser.add_argument('--interp_dtype', default='float32')
+  parser.add_argument('--clean_workers', type=int, default=0)
+  parser.add_argument('--stages', default=','.join(STAGES), help='comma separated subset of %s' % ','.join(STAGES))
+  parser.add_argument('--workdir', default=None, help='kept after the run when given')
+  parser.add_argument('--output', default=None, help='also write the results to this json file')
+  parser.add_argument('--run_stage', default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.run_stage:
+    run_stage(args.run_stage)
+    return
+
+  stages = args.stages.split(',')
+  workdir = args.workdir or tempfile.mkdtemp(prefix='nsynth_benchmark_')
+  os.makedirs(workdir, exist_ok=True)
+  make_fixture(workdir, args)
+
+  results = {}
+  try:
+    for stage in STAGES:
+      #  later stages need the interpolated embeddings and generated audio
+      if stage not in stages and not (stage == 'interpolate' and set(stages) & {'batch', 'clean'}):
+        continue
+      if stage == 'clean':
+        benchmark_stage(workdir, 'fixture_audio')
+      result = benchmark_stage(workdir, stage)
+      if stage in stages:
+        results[stage] = result
+        print("%-12s %8.2f s %10.1f files/s %8.1f MB peak RSS %10.1f MB written" % (
+          stage, result['wall_time'], result['files_per_sec'] or 0,
+          result['peak_rss'] / 2.0**20, result['bytes_written'] / 2.0**20))
+  finally:
+    if args.workdir is None:
+      shutil.rmtree(workdir)
+
+  if args.output:
+    with open(args.output, 'w') as outfile:
+      json.dump({'settings': vars(args), 'results': results}, outfile, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,240 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Generation spread over several hosts that share a working_dir, without a
+# central service.
+#
+# Every host derives the same chunk plan from the interpolation index. A host
+# claims a chunk by atomically creating leases/<chunk>.lease and keeps renewing
+# it (by touching it) while it works. A lease that has not been renewed for
+# lease_ttl seconds belongs to a host that died, and can be broken and
+# re-claimed by any other host. Finished chunks get a done/<chunk> marker.
+# Host clocks and the file server's clock need to agree to well within the TTL.
+import json, os, socket, threading, time
+from supervisor import Chunk, GenerationSupervisor
+
+
+def default_host_id():
+  return '%s-%i' % (socket.gethostname(), os.getpid())
+
+
+class LeaseQueue(object):
+
+  def __init__(self, root, host_id, ttl):
+    self.host_id = host_id
+    self.ttl = ttl
+    self.lease_dir = os.path.join(root, 'leases')
+    self.done_dir = os.path.join(root, 'done')
+    os.makedirs(self.lease_dir, exist_ok=True)
+    os.makedirs(self.done_dir, exist_ok=True)
+
+    self.lock = threading.Lock()
+    self.held = set()
+    self.heartbeat = None
+    self.stopped = threading.Event()
+
+  def _lease_path(self, chunk_id):
+    return os.path.join(self.lease_dir, chunk_id + '.lease')
+
+  def done_chunks(self):
+    return set(os.listdir(self.done_dir))
+
+  def leased_chunks(self):
+    return set(fname[:-len('.lease')] for fname in os.listdir(self.lease_dir) if fname.endswith('.lease'))
+
+  def is_done(self, chunk_id):
+    return os.path.exists(os.path.join(self.done_dir, chunk_id))
+
+  def mark_done(self, chunk_id):
+    open(os.path.join(self.done_dir, chunk_id), 'w').close()
+
+  def clear_done(self, chunk_id):
+    try:
+      os.remove(os.path.join(self.done_dir, chunk_id))
+    except FileNotFoundError:
+      pass
+    self.release(chunk_id)
+
+  def _create(self, chunk_id):
+    try:
+      fd = os.open(self._lease_path(chunk_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      return False
+    with os.fdopen(fd, 'w') as lease:
+      json.dump({'host': self.host_id, 'claimed': time.time()}, lease)
+    with self.lock:
+      self.held.add(chunk_id)
+    return True
+
+  def _expired(self, path):
+    try:
+      return time.time() - os.stat(path).st_mtime > self.ttl
+    except FileNotFoundError:
+      return False
+
+  def _break(self, chunk_id):
+    #  renaming is atomic, so only one host gets to break an expired lease
+    path = self._lease_path(chunk_id)
+    broken = '%s.broken-%s' % (path, self.host_id)
+    try:
+      os.rename(path, broken)
+    except FileNotFoundError:
+      return False
+    if not self._expired(broken):
+      #  renewed in the meantime, put it back unless someone already re-claimed the chunk
+      try:
+        os.link(broken, path)
+      except FileExistsError:
+        pass
+      os.remove(broken)
+      return False
+    os.remove(broken)
+    return True
+
+  def claim(self, chunk_id):
+    if self._create(chunk_id):
+      return True
+    if self._expired(self._lease_path(chunk_id)) and self._break(chunk_id):
+      print("Re-claiming expired lease of chunk %s" % chunk_id)
+      return self._create(chunk_id)
+    return False
+
+  def _owner(self, chunk_id):
+    try:
+      with open(self._lease_path(chunk_id), 'r') as lease:
+        return json.load(lease)['host']
+    except (FileNotFoundError, ValueError):
+      return None
+
+  def renew(self):
+    with self.lock:
+      held = list(self.held)
+    for chunk_id in held:
+      if self._owner(chunk_id) == self.host_id:
+        try:
+          os.utime(self._lease_path(chunk_id))
+          continue
+        except FileNotFoundError:
+          #  broken between reading the owner and renewing
+          pass
+      #  another host broke our lease, it will generate the chunk as well
+      print("Lost the lease of chunk %s" % chunk_id)
+      with self.lock:
+        self.held.discard(chunk_id)
+
+  def release(self, chunk_id):
+    with self.lock:
+      if chunk_id not in self.held:
+        return
+      self.held.discard(chunk_id)
+    if self._owner(chunk_id) == self.host_id:
+      try:
+        os.remove(self._lease_path(chunk_id))
+      except FileNotFoundError:
+        pass
+
+  def start(self):
+    def beat():
+      while not self.stopped.wait(self.ttl / 3.0):
+        #  a failed renewal must not stop the heartbeat, the next one may succeed
+        try:
+          self.renew()
+        except Exception as e:
+          print("Renewing leases failed (%s)" % e)
+    self.heartbeat = threading.Thread(target=beat, daemon=True)
+    self.heartbeat.start()
+
+  def stop(self):
+    self.stopped.set()
+    if self.heartbeat is not None:
+      self.heartbeat.join()
+    with self.lock:
+      held = list(self.held)
+    for chunk_id in held:
+      self.release(chunk_id)
+
+
+class DistributedSupervisor(GenerationSupervisor):
+  """Supervisor whose workers claim chunks through a LeaseQueue.
+
+  run() takes the full chunk plan, which has to be identical on every host,
+  and returns once every chunk is done, or has failed max_retries times on
+  this host.
+  """
+
+  def __init__(self, leases, devices, prepare, finish, is_done, poll_interval=10.0, **kwargs):
+    super(DistributedSupervisor, self).__init__(devices, prepare, finish, is_done, **kwargs)
+    self.leases = leases
+    self.poll_interval = poll_interval
+    self.plan = []
+    self.attempts = {}
+    self.given_up = set()
+
+  def queue_depth(self):
+    #  embeddings of chunks that are neither done nor being worked on by any host
+    taken = self.leases.done_chunks() | self.leases.leased_chunks() | self.given_up
+    return sum(len(chunk.names) for chunk in self.plan if chunk.chunk_id not in taken)
+
+  def _next_chunk(self, worker):
+    #  chunks are claimed in the order of the plan, which generates the coarse levels of the grid first
+    while not self.stopping:
+      pending = False
+      for chunk in self.plan:
+        if chunk.chunk_id in self.given_up:
+          continue
+        if self.leases.is_done(chunk.chunk_id):
+          #  a marker is only trusted while the audio of the chunk is still there
+          if all(self.is_done(name) for name in chunk.names):
+            continue
+          self.leases.clear_done(chunk.chunk_id)
+        pending = True
+        if not self.leases.claim(chunk.chunk_id):
+          continue
+        missing = [name for name in chunk.names if not self.is_done(name)]
+        if not missing:
+          self.leases.mark_done(chunk.chunk_id)
+          continue
+        return Chunk(chunk.chunk_id, missing, self.attempts.get(chunk.chunk_id, 0))
+      if not pending:
+        return None
+      #  the remaining chunks are leased by other hosts, wait for them to finish or expire
+      time.sleep(self.poll_interval)
+    return None
+
+  def _finish_chunk(self, worker, chunk, seconds):
+    missing = [name for name in chunk.names if not self.is_done(name)]
+    if not missing:
+      self.leases.mark_done(chunk.chunk_id)
+      self.chunk_done(worker, chunk, seconds)
+      return
+
+    #  hand the chunk back, this or another host retries it
+    with self.lock:
+      self.attempts[chunk.chunk_id] = chunk.attempts + 1
+      if chunk.attempts >= self.max_retries:
+        self.given_up.add(chunk.chunk_id)
+        self.failed.extend(missing)
+    self.leases.release(chunk.chunk_id)
+    if chunk.chunk_id in self.given_up:
+      self.chunk_failed(worker, chunk, missing, seconds)
+    else:
+      self.chunk_retried(worker, chunk, missing, seconds)
+
+  def run(self, chunks):
+    self.plan = list(chunks)
+    self.leases.start()
+    try:
+      return self._run_workers()
+    finally:
+      self.leases.stop()
@@ -0,0 +1,78 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Persistent cache of nsynth_save_embeddings outputs shared across grids and
+# runs. Entries are keyed by the content of the encoded audio, the checkpoint
+# and the sample length, and are evicted least recently used first once the
+# cache grows past its size cap.
+import hashlib, os, shutil, tempfile
+
+
+class EmbeddingCache(object):
+
+  def __init__(self, cache_dir, max_bytes):
+    self.cache_dir = os.path.expanduser(cache_dir)
+    self.max_bytes = max_bytes
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+  def key(self, audio_path, checkpoint_path, sample_length):
+    digest = hashlib.sha1()
+    digest.update(("%s\0%s\0" % (os.path.expanduser(checkpoint_path), sample_length)).encode('utf-8'))
+    with open(audio_path, 'rb') as audio:
+      for block in iter(lambda: audio.read(1 << 20), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, key + '.npy')
+
+  def fetch(self, key, target):
+    #  copy a cached embedding to target, returns False on a miss
+    path = self._path(key)
+    try:
+      shutil.copyfile(path, target)
+    except FileNotFoundError:
+      return False
+    #  mark as recently used
+    os.utime(path)
+    return True
+
+  def store(self, key, source):
+    #  write through a temp file so concurrent runs never see partial entries
+    fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+      shutil.copyfile(source, temp_path)
+      os.replace(temp_path, self._path(key))
+    finally:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+    self.evict()
+
+  def evict(self):
+    entries = []
+    for entry in os.scandir(self.cache_dir):
+      if entry.name.endswith('.npy'):
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
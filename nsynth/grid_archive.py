@@ -0,0 +1,107 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Packed grid output: every encoded sample of a grid concatenated into one
+# grid.pack file, followed by an index mapping (x, y, pitch) to the offset and
+# length of each sample, and the 8 byte offset of that index. Keeping the index
+# in the pack replaces both at once, so readers never mix the index of one pack
+# with the samples of another. GridArchive memory-maps the pack so any sample
+# can be read without opening a file per sample.
+#
+#   with GridArchive('output_grids/multigrid_4') as grid:
+#     mp3_bytes = bytes(grid.get(0.12, 0.36, 60))
+import io, mmap, os, re, struct
+import numpy as np
+
+PACK_FILE = 'grid.pack'
+#  the little-endian offset of the index, at the very end of the pack
+FOOTER = struct.Struct('<q')
+INDEX_DTYPE = np.dtype([('idx', '<i4'), ('x', '<f4'), ('y', '<f4'), ('pitch', '<i4'),
+                        ('offset', '<i8'), ('length', '<i8')])
+
+#  the tail of the sample names written by generate.py
+SAMPLE_NAME = re.compile(r'_(\d+)_x(-?[\d.]+)_y(-?[\d.]+)_pitch(\d+)\.[^.]+$')
+
+
+def _key(x, y, pitch):
+  #  coordinates are only kept to two decimals in the sample names
+  return int(round(float(x) * 100)), int(round(float(y) * 100)), int(pitch)
+
+
+def pack_grid(sample_files, grid_dir):
+  """Packs sample files named like generate.py's outputs into grid_dir."""
+  entries = []
+  for sample_file in sample_files:
+    match = SAMPLE_NAME.search(os.path.basename(sample_file))
+    if match is None:
+      raise ValueError("Not a grid sample name: %s" % sample_file)
+    idx, x, y, pitch = match.groups()
+    entries.append((int(idx), float(x), float(y), int(pitch), sample_file))
+  entries.sort(key=lambda entry: (entry[0], entry[3]))
+
+  index = np.zeros(len(entries), dtype=INDEX_DTYPE)
+  os.makedirs(grid_dir, exist_ok=True)
+  pack_path = os.path.join(grid_dir, PACK_FILE)
+  offset = 0
+  with open(pack_path + '.tmp', 'wb') as pack:
+    for i, (idx, x, y, pitch, sample_file) in enumerate(entries):
+      with open(sample_file, 'rb') as sample:
+        data = sample.read()
+      pack.write(data)
+      index[i] = (idx, x, y, pitch, offset, len(data))
+      offset += len(data)
+    np.save(pack, index)
+    pack.write(FOOTER.pack(offset))
+
+  os.replace(pack_path + '.tmp', pack_path)
+  return index
+
+
+class GridArchive(object):
+
+  def __init__(self, grid_dir):
+    self._file = open(os.path.join(grid_dir, PACK_FILE), 'rb')
+    self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    index_offset, = FOOTER.unpack(self._data[-FOOTER.size:])
+    self.index = np.load(io.BytesIO(self._data[index_offset:-FOOTER.size]))
+    self.lookup = {_key(entry['x'], entry['y'], entry['pitch']): i for i, entry in enumerate(self.index)}
+
+  def __len__(self):
+    return len(self.index)
+
+  def __contains__(self, key):
+    return _key(*key) in self.lookup
+
+  def keys(self):
+    return [(float(entry['x']), float(entry['y']), int(entry['pitch'])) for entry in self.index]
+
+  def get(self, x, y, pitch):
+    """Returns the encoded sample at (x, y, pitch) as a zero-copy memoryview."""
+    entry = self.index[self.lookup[_key(x, y, pitch)]]
+    return memoryview(self._data)[entry['offset']:entry['offset'] + entry['length']]
+
+  def close(self):
+    #  views returned by get may outlive the archive, the pack is then unmapped once the last one is gone
+    try:
+      self._data.close()
+    except BufferError:
+      pass
+    self._data = None
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
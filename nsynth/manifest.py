@@ -0,0 +1,83 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Records the inputs and outputs of each stage of generate.py so that a rerun
+# can skip finished stages and only redo the items that are missing or stale.
+#
+# Every stage has a fingerprint of the settings it depends on. Changing the
+# fingerprint resets the stage, otherwise individual items (input files,
+# embeddings, generated wavs) are compared by content hash.
+import hashlib, json, os
+
+
+def digest(obj):
+  return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def digest_file(path):
+  sha = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+
+class Manifest(object):
+
+  def __init__(self, path):
+    self.path = path
+    self.stages = {}
+    if os.path.isfile(path):
+      with open(path, 'r') as infile:
+        self.stages = json.load(infile)['stages']
+
+  def begin(self, stage, fingerprint):
+    #  start (or resume) a stage, forgetting its items if its settings changed
+    record = self.stages.get(stage)
+    if record is None or record['fingerprint'] != fingerprint:
+      record = {'fingerprint': fingerprint, 'complete': False, 'items': {}, 'outputs': []}
+      self.stages[stage] = record
+      return False
+    record['complete'] = False
+    return True
+
+  def is_complete(self, stage, fingerprint):
+    record = self.stages.get(stage)
+    return (record is not None and record['complete'] and record['fingerprint'] == fingerprint
+            and all(os.path.exists(output) for output in record['outputs']))
+
+  def item(self, stage, name):
+    return self.stages[stage]['items'].get(name)
+
+  def item_fresh(self, stage, name, signature):
+    return self.stages[stage]['items'].get(name) == signature
+
+  def set_item(self, stage, name, signature):
+    self.stages[stage]['items'][name] = signature
+
+  def drop_item(self, stage, name):
+    self.stages[stage]['items'].pop(name, None)
+
+  def complete(self, stage, outputs=()):
+    self.stages[stage]['complete'] = True
+    self.stages[stage]['outputs'] = list(outputs)
+    self.save()
+
+  def save(self):
+    #  write atomically so a crash never leaves a truncated manifest behind
+    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+    temp_path = self.path + '.tmp'
+    with open(temp_path, 'w') as outfile:
+      json.dump({'stages': self.stages}, outfile, indent=1, sort_keys=True)
+    os.replace(temp_path, self.path)
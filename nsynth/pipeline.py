@@ -0,0 +1,1039 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Adapted from the Open NSynth Super audio generation pipeline found at
+# https://github.com/googlecreativelab/open-nsynth-super/tree/master/audio
+# Changes were made to ensure output audio files conform with the NSynth
+# MaxForLive device's epectations and so that the entire pipeline could be
+# run at once.
+#
+# The stages of the pipeline are methods of GridPipeline, which takes the
+# settings and the directories to work in explicitly, so it can be imported
+# without touching the current directory:
+#
+#   pipeline = GridPipeline.from_settings_file('settings.json')
+#   pipeline.interpolate_embeddings()
+#
+# librosa, scipy and tqdm are only imported by the stages that use them.
+import json, os, subprocess, shutil, sys, queue, threading
+from os.path import basename, isfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from embedding_cache import EmbeddingCache
+from manifest import Manifest, digest, digest_file
+from supervisor import Chunk, GenerationSupervisor
+from distributed import LeaseQueue, DistributedSupervisor, default_host_id
+from resident import ResidentRunner
+from grid_archive import pack_grid, PACK_FILE
+
+AUDIO_EXTENSIONS = ('.wav', '.aif', '.aiff', '.flac', '.ogg', '.mp3')
+
+#  source is the row whose embedding (and generated audio) a row shares, itself when unique
+INTERP_INDEX_DTYPE = np.dtype([('idx', np.int32), ('x', np.float64), ('y', np.float64), ('pitch', np.int32),
+                               ('source', np.int32)])
+
+
+def write_wav(target_file, audio):
+  #  16-bit, written atomically
+  import scipy.io.wavfile
+  data_16bit = np.clip(np.round(audio * 2**15), -2**15, 2**15 - 1).astype(np.int16)
+  temp_file = target_file + '.%i.tmp' % os.getpid()
+  with open(temp_file, 'wb') as outfile:
+    scipy.io.wavfile.write(outfile, 16000, data_16bit)
+  os.replace(temp_file, target_file)
+
+
+def decode_audio(source_file, target_file):
+  #  decode and resample to 16 kHz mono
+  import librosa
+  audio, sr = librosa.core.load(source_file, sr=16000, mono=True)
+  write_wav(target_file, audio)
+
+
+def shift_pitch(anchor_file, n_steps, target_file):
+  import librosa
+  audio, sr = librosa.core.load(anchor_file, sr=16000)
+  if n_steps:
+    audio = librosa.effects.pitch_shift(audio, sr=sr, n_steps=n_steps)
+  write_wav(target_file, audio)
+
+
+def grid_weights(x, y):
+  #  corners of the sub grid each point falls into, same order as the instruments
+  u, v = np.floor(x).astype(int), np.floor(y).astype(int)
+  corners = np.stack([np.stack([u, v], axis=-1), np.stack([u, v + 1], axis=-1),
+                      np.stack([u + 1, v], axis=-1), np.stack([u + 1, v + 1], axis=-1)], axis=1)
+
+  #  weight each corner by its (clipped) distance to the point
+  distances = np.linalg.norm(np.stack([x, y], axis=-1)[:, None, :] - corners, axis=2)
+  distances = np.maximum(1 - distances, 0)
+  distances /= distances.sum(axis=1, keepdims=True)
+  return corners, distances
+
+
+def postprocess_audio(audio):
+  #   remove clicks, i.e. single samples that jump away from both neighbours
+  d = audio[1:] - audio[:-1]
+  d_thresh = np.flatnonzero(np.abs(d) > 1.0)
+  clicks = d_thresh[:-1][np.diff(d_thresh) == 1]
+  #  clicks right after another one average the neighbour repaired before them, so only the first click
+  #  of every run is repaired at once and the rest of the run in order
+  chained = np.isin(clicks - 1, clicks)
+  first = clicks[~chained]
+  audio[first + 1] = (audio[first] + audio[first + 2]) / 2.0
+  for click in clicks[chained]:
+    audio[click + 1] = (audio[click] + audio[click + 2]) / 2.0
+
+  #  normalize the peak to -12 dBFS, as sox --norm=-12 did
+  peak = np.abs(audio).max() if len(audio) else 0.0
+  if peak > 0:
+    audio = audio * (10 ** (-12 / 20.0) / peak)
+
+  data_16bit = np.clip(np.round(audio * 2**15), -2**15, 2**15 - 1)
+  return data_16bit.astype(np.int16)
+
+
+def encode_mp3(data_16bit, mp3_file):
+  try:
+    import lameenc
+  except ImportError:
+    lameenc = None
+  if lameenc is not None:
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(128)
+    encoder.set_in_sample_rate(16000)
+    encoder.set_channels(1)
+    encoder.set_quality(3)
+    with open(mp3_file, 'wb') as outfile:
+      outfile.write(encoder.encode(data_16bit.tobytes()) + encoder.flush())
+  else:
+    #  stream raw samples into a single lame process, no intermediate wavs
+    subprocess.run(["lame", "--quiet", "-r", "-s", "16", "--bitwidth", "16", "--signed", "--little-endian",
+                    "-m", "m", "-", mp3_file], input=data_16bit.astype('<i2').tobytes(), check=True)
+
+
+def clean_file(fpath, original_path, cleaned_path, mp3_name):
+  import librosa
+  audio, sr = librosa.core.load(os.path.join(original_path, fpath), sr=16000)
+  data_16bit = postprocess_audio(audio)
+
+  #  convert to mp3
+  encode_mp3(data_16bit, os.path.join(cleaned_path, mp3_name))
+
+
+def _clean_file_isolated(args):
+  #  a bad file is reported back instead of aborting the whole grid
+  try:
+    clean_file(*args)
+    return None
+  except Exception as e:
+    return "%s: %s" % (type(e).__name__, e)
+
+
+class StreamingCleaner(object):
+  #  cleans wavs while generation continues, with a bounded number of files in flight
+
+  def __init__(self, pipeline, workers, max_inflight):
+    self.pipeline = pipeline
+    self.manifest = pipeline.manifest
+    self.original_path, self.cleaned_path = pipeline.clean_paths()
+    self.max_inflight = max_inflight
+    self.failures = {}
+    self.cleaned = 0
+    self.queue = queue.Queue()
+    self.manifest.begin('clean', digest([pipeline.grid_name()]))
+
+    self.pool = ProcessPoolExecutor(max_workers=workers)
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def submit(self, files):
+    for fpath in files:
+      self.queue.put(fpath)
+
+  def _run(self):
+    inflight = {}
+    closing = False
+    while not (closing and not inflight):
+      #  top up the pool without blocking while files are being cleaned
+      while not closing and len(inflight) < self.max_inflight:
+        try:
+          fpath = self.queue.get(timeout=None if not inflight else 0.1)
+        except queue.Empty:
+          break
+        if fpath is None:
+          closing = True
+          break
+        fpath_hash = digest_file(os.path.join(self.original_path, fpath))
+        if self.pipeline.is_cleaned(fpath, fpath_hash, self.cleaned_path):
+          continue
+        future = self.pool.submit(_clean_file_isolated, (fpath, self.original_path, self.cleaned_path,
+                                                         self.pipeline.cleaned_file(fpath)))
+        inflight[future] = (fpath, fpath_hash)
+
+      if not inflight:
+        continue
+      done, _ = wait(inflight, timeout=0.1, return_when=FIRST_COMPLETED)
+      for future in done:
+        fpath, fpath_hash = inflight.pop(future)
+        error = future.result()
+        if error is not None:
+          self.failures[fpath] = error
+          continue
+        self.manifest.set_item('clean', fpath, fpath_hash)
+        self.cleaned += 1
+        if self.cleaned % 100 == 0:
+          self.manifest.save()
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    self.pool.shutdown()
+    self.manifest.save()
+    print("Cleaned %i files while generating" % self.cleaned)
+
+
+class GridPipeline(object):
+  """Generates a grid of interpolated NSynth samples for the MaxForLive device.
+
+  settings is the dict read from settings.json. Input samples are read from
+  input_dir, intermediate files are kept in working_dir and the finished grid
+  is written to output_dir/<name>. Any directory that is not given is
+  audio_input, working_dir or output_grids inside root_dir. The embeddings of
+  the input samples are read from embedding_dir, working_dir/embeddings/input
+  by default.
+  """
+
+  def __init__(self, settings, root_dir='.', input_dir=None, working_dir=None, output_dir=None, embedding_dir=None):
+    self.settings = settings
+    self.root_dir = os.path.abspath(root_dir)
+    self.input_dir = os.path.abspath(input_dir or os.path.join(self.root_dir, 'audio_input'))
+    self.working_dir = os.path.abspath(working_dir or os.path.join(self.root_dir, 'working_dir'))
+    self.output_dir = os.path.abspath(output_dir or os.path.join(self.root_dir, 'output_grids'))
+    self.embedding_dir = os.path.abspath(embedding_dir or self.path('embeddings', 'input'))
+
+    #  record of finished stages, used to resume interrupted runs
+    self.manifest = Manifest(self.path('manifest.json'))
+
+    #  hosts sharing working_dir claim chunks through lease files
+    self.distributed = settings.get('distributed', False)
+    self.host_id = settings.get('host_id') or default_host_id()
+
+    #  preview grids only decode a few anchor pitches and pitch shift the others from them
+    self.preview = settings.get('preview', False)
+
+  @classmethod
+  def from_settings_file(cls, settings_path='settings.json', **paths):
+    #  directories default to the one holding the settings file
+    with open(settings_path, 'r') as infile:
+      settings = json.load(infile)
+    paths.setdefault('root_dir', os.path.dirname(os.path.abspath(settings_path)))
+    return cls(settings, **paths)
+
+  def path(self, *parts):
+    return os.path.join(self.working_dir, *parts)
+
+  def ingest_audio(self):
+    #  audio_input is never modified, converted samples are cached by source hash
+    from tqdm import tqdm
+    settings = self.settings
+    cache_dir = os.path.join(self.root_dir, settings['ingest_cache_dir']) if settings.get('ingest_cache_dir') \
+        else self.path('ingest_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.rmtree(self.path('audio_16k'), ignore_errors=True)
+    os.makedirs(self.path('audio_16k'))
+
+    sources = sorted(f for f in os.listdir(self.input_dir) if os.path.splitext(f)[1].lower() in AUDIO_EXTENSIONS)
+    cached = {fname: os.path.join(cache_dir, digest_file(os.path.join(self.input_dir, fname)) + '_16k.wav')
+              for fname in sources}
+    pending = [fname for fname in sources if not isfile(cached[fname])]
+
+    print("Converting %i of %i input samples" % (len(pending), len(sources)))
+    if pending:
+      with ProcessPoolExecutor(max_workers=settings.get('ingest_workers') or os.cpu_count()) as pool:
+        list(tqdm(pool.map(decode_audio, [os.path.join(self.input_dir, f) for f in pending],
+                           [cached[f] for f in pending]), total=len(pending)))
+
+    for fname in sources:
+      target = self.path('audio_16k', os.path.splitext(fname)[0] + '.wav')
+      if isfile(target):
+        raise ValueError("More than one input sample is named %s" % os.path.splitext(fname)[0])
+      try:
+        os.link(cached[fname], target)
+      except OSError:
+        shutil.copyfile(cached[fname], target)
+
+  def compute_embeddings(self):
+    settings = self.settings
+    manifest = self.manifest
+    self.ingest_audio()
+
+    checkpoint_path = "%s/model.ckpt-200000" % settings['checkpoint_dir']
+    input_dir = self.embedding_dir
+    os.makedirs(input_dir, exist_ok=True)
+
+    #  reuse embeddings of samples encoded by earlier runs or other grids
+    cache = None
+    if settings.get('embedding_cache_dir', '~/.cache/nsynth_embeddings'):
+      cache = EmbeddingCache(settings.get('embedding_cache_dir', '~/.cache/nsynth_embeddings'),
+                             settings.get('embedding_cache_size_mb', 1024) * 2**20)
+
+    samples = sorted(f for f in os.listdir(self.path('audio_16k')) if f.endswith('.wav'))
+    hashes = {fname: digest_file(self.path('audio_16k', fname)) for fname in samples}
+    manifest.begin('embeddings', digest([settings['checkpoint_dir'], settings['final_length']]))
+
+    pending = {}
+    for fname in samples:
+      target = os.path.join(input_dir, os.path.splitext(fname)[0] + '_embeddings.npy')
+      if manifest.item_fresh('embeddings', fname, hashes[fname]) and isfile(target):
+        continue
+      if cache is None:
+        pending[fname] = None
+        continue
+      key = cache.key(self.path('audio_16k', fname), checkpoint_path, settings['final_length'])
+      if not cache.fetch(key, target):
+        pending[fname] = key
+
+    print("%i of %i samples need encoding" % (len(pending), len(samples)))
+    if pending:
+      #  only hand the samples that are stale and missing from the cache to the encoder
+      staging_dir = self.path('embeddings', 'pending')
+      shutil.rmtree(staging_dir, ignore_errors=True)
+      os.makedirs(staging_dir)
+      for fname in pending:
+        #  stale embeddings would stop truncated output names from being corrected
+        target = os.path.join(input_dir, os.path.splitext(fname)[0] + '_embeddings.npy')
+        if isfile(target):
+          os.remove(target)
+        os.symlink(self.path('audio_16k', fname), os.path.join(staging_dir, fname))
+
+      subprocess.check_call(["nsynth_save_embeddings",
+        "--checkpoint_path=%s" % checkpoint_path,
+        "--source_path=%s" % staging_dir,
+        "--save_path=%s" % input_dir,
+        "--batch_size=%i" % settings["batch_size_embeddings"],
+        "--sample_length=%s" % settings["final_length"]])
+      shutil.rmtree(staging_dir)
+      self.correct_truncated_names()
+
+      if cache is not None:
+        for fname, key in pending.items():
+          cache.store(key, os.path.join(input_dir, os.path.splitext(fname)[0] + '_embeddings.npy'))
+
+    for fname in samples:
+      manifest.set_item('embeddings', fname, hashes[fname])
+    manifest.complete('embeddings')
+
+  def correct_truncated_names(self):
+    input_dir = self.embedding_dir
+    for original_name in os.listdir(self.path('audio_16k')):
+      if isfile(os.path.join(input_dir, os.path.splitext(original_name)[0] + "_embeddings.npy")):
+        continue
+      else:
+        for misnomer in os.listdir(input_dir):
+          if misnomer.replace('_embeddings.npy','') in original_name:
+            os.rename(os.path.join(input_dir, misnomer),
+                      os.path.join(input_dir, os.path.splitext(original_name)[0] + "_embeddings.npy"))
+            break
+
+  def grid_resolution(self):
+    grid_size = len(self.settings['instruments'][0]) - 1
+    return (self.settings['resolution'] - 1) * grid_size + 1
+
+  def grid_coordinates(self):
+    instrument_grid = self.settings['instruments']
+    grid_size = len(instrument_grid[0]) - 1
+
+    #  set up sub grid
+    res = self.grid_resolution()
+    eps = 1e-10 # required to ensure correct organization of samples in multigrids
+    x, y = np.meshgrid(np.linspace(eps, grid_size, res + 1), np.linspace(eps, grid_size, res + 1))
+    return x.reshape(-1) - eps, y.reshape(-1) - eps
+
+  def grid_strides(self):
+    #  point strides of successively finer levels of the grid, from the corners down to every point;
+    #  each stride divides the previous one, so every level is a uniform grid containing the coarser ones
+    stride, strides = self.grid_resolution(), []
+    while stride > 1:
+      strides.append(stride)
+      stride //= next(factor for factor in range(2, stride + 1) if stride % factor == 0)
+    return strides + [1]
+
+  def grid_levels(self, index):
+    #  the coarsest level every row of the interpolation index belongs to
+    i, j = np.divmod(index['idx'], self.grid_resolution() + 1)
+    strides = self.grid_strides()
+    levels = np.full(len(index), len(strides) - 1)
+    for level, stride in reversed(list(enumerate(strides))):
+      levels[(i % stride == 0) & (j % stride == 0)] = level
+    return levels
+
+  def completed_level(self, index):
+    #  the finest level of the grid whose audio has been generated completely, None before the corners are
+    levels = self.grid_levels(index)
+    grid_file = self.preview_file if self.preview else self.generated_file
+    done = np.array([isfile(grid_file(name)) for name in self.interp_names(index)])
+    completed = None
+    for level in range(len(self.grid_strides())):
+      if not done[levels <= level].all():
+        break
+      completed = level
+    return completed
+
+  def completed_stride(self):
+    #  stride of the finest level of the grid whose audio has been generated completely
+    level = self.completed_level(self.load_interp_index())
+    return None if level is None else self.grid_strides()[level]
+
+  def interp_name(self, idx, x, y, pitch):
+    return "%s_%06d_x%.2f_y%.2f_pitch%s" % (self.settings['name'], idx, x, y, pitch)
+
+  def interp_names(self, index):
+    return [self.interp_name(entry['idx'], entry['x'], entry['y'], entry['pitch']) for entry in index]
+
+  def load_interp_index(self):
+    return np.load(self.path('embeddings', 'interp_index.npy'))
+
+  def open_interp_store(self, mode='r'):
+    return np.load(self.path('embeddings', 'interp.npy'), mmap_mode=mode)
+
+  def interpolation_fingerprint(self):
+    settings = self.settings
+    storage = settings.get('interp_storage', 'files')
+    dtype = np.dtype(settings.get('interp_dtype', 'float32')) if storage == 'memmap' else np.dtype(np.float32)
+    parts = [settings['name'], settings['instruments'], settings['pitches'], settings['resolution'], dtype.str]
+    if settings.get('dedup_decimals') is not None:
+      parts.append(settings['dedup_decimals'])
+    return digest(parts)
+
+  def is_interpolated(self):
+    return self.manifest.is_complete('interpolation', self.interpolation_fingerprint())
+
+  def grid_instruments(self):
+    #  the distinct instruments, and the position of every instrument of the grid among them
+    instrument_grid = self.settings['instruments']
+    instruments = sorted(set(instrument for row in instrument_grid for instrument in row))
+    instrument_ids = np.array([[instruments.index(instrument) for instrument in row] for row in instrument_grid])
+    return instruments, instrument_ids
+
+  def instrument_weights(self, instrument_ids, corners, weights, n_instruments):
+    #  an interpolated embedding only depends on the weight of every instrument at its point
+    sub_grids = instrument_ids[corners[..., 0], corners[..., 1]]
+    instrument_weights = np.zeros((len(weights), n_instruments))
+    np.add.at(instrument_weights, (np.arange(len(weights))[:, None], sub_grids), weights)
+    if self.settings.get('dedup_decimals') is not None:
+      instrument_weights = np.round(instrument_weights, self.settings['dedup_decimals'])
+    return instrument_weights
+
+  def unique_points(self, instrument_ids, corners, weights, n_instruments):
+    #  points with the same weights (e.g. where an instrument appears more than once in the grid) are duplicates
+    instrument_weights = self.instrument_weights(instrument_ids, corners, weights, n_instruments)
+    _, first, inverse = np.unique(instrument_weights, axis=0, return_index=True, return_inverse=True)
+    return first[inverse.reshape(-1)]
+
+  def embedding_keys(self, index):
+    #  what the interpolated embedding of each row is made of, comparable between grids
+    instruments, instrument_ids = self.grid_instruments()
+    corners, weights = grid_weights(*self.grid_coordinates())
+    instrument_weights = self.instrument_weights(instrument_ids, corners, weights, len(instruments))
+    keys = []
+    for entry in index:
+      point_weights = instrument_weights[entry['idx']]
+      keys.append((int(entry['pitch']),) + tuple((instruments[i], float(point_weights[i]))
+                                                 for i in np.flatnonzero(point_weights)))
+    return keys
+
+  def interpolate_embeddings(self):
+    #  constants and rearrangement of settings vars for processing
+    settings = self.settings
+    manifest = self.manifest
+    pitches = settings['pitches']
+    storage = settings.get('interp_storage', 'files')
+    dtype = np.dtype(settings.get('interp_dtype', 'float32'))
+    chunk_size = settings.get('interp_chunk_size', 256)
+    input_dir = self.embedding_dir
+    interp_dir = self.path('embeddings', 'interp')
+
+    #  cache all embeddings
+    embeddings_lookup = {}
+    embedding_hashes = {}
+
+    for filename in os.listdir(input_dir):
+      #  ignore all non-npy files
+      if '.npy' in  filename:
+        #  convert filename to reference key
+        parts = basename(filename).split('_')
+        reference = '{}_{}'.format(parts[0], parts[1])
+
+        #  load the saved embedding
+        embeddings_lookup[reference] = np.load(os.path.join(input_dir, filename))
+        embedding_hashes[reference] = digest_file(os.path.join(input_dir, filename))
+
+    #  stack embeddings into a (instrument, pitch, time, channel) tensor
+    instruments, instrument_ids = self.grid_instruments()
+    embeddings = np.stack([np.stack([embeddings_lookup['{}_{}'.format(instrument, pitch)] for pitch in pitches])
+                           for instrument in instruments])
+
+    #  weights and corner instruments for the whole grid at once
+    x, y = self.grid_coordinates()
+    corners, weights = grid_weights(x, y)
+    sub_grids = instrument_ids[corners[..., 0], corners[..., 1]]
+
+    #  one row per (grid point, pitch), in the order of the original file names
+    index = np.zeros(len(x) * len(pitches), dtype=INTERP_INDEX_DTYPE)
+    index['idx'] = np.repeat(np.arange(len(x)), len(pitches))
+    index['x'] = np.repeat(x, len(pitches))
+    index['y'] = np.repeat(y, len(pitches))
+    index['pitch'] = np.tile(pitches, len(x))
+    source_points = self.unique_points(instrument_ids, corners, weights, len(instruments))
+    index['source'] = (np.repeat(source_points, len(pitches)) * len(pitches) + np.tile(np.arange(len(pitches)), len(x)))
+    names = self.interp_names(index)
+    unique = index['source'] == np.arange(len(index))
+
+    os.makedirs(interp_dir, exist_ok=True)
+    np.save(self.path('embeddings', 'interp_index.npy'), index)
+
+    #  a row is invalid when its own signature changed, changing the grid settings keeps every row
+    #  whose corner embeddings, weights and dtype are the same
+    fresh = manifest.begin('interpolation', self.interpolation_fingerprint())
+    if not fresh:
+      #  leases and done markers of distributed runs belong to the chunks of the old grid
+      shutil.rmtree(self.path('distributed'), ignore_errors=True)
+    signatures = self.row_signatures(index, instruments, sub_grids, weights, embedding_hashes)
+    previous = self.load_row_signatures()
+    if previous is None:
+      #  manifests of earlier versions only know the embeddings, compare those
+      changed = np.array([[not fresh or not manifest.item_fresh('interpolation', '{}_{}'.format(instrument, pitch),
+                                                                embedding_hashes['{}_{}'.format(instrument, pitch)])
+                           for pitch in pitches] for instrument in instruments])
+      invalid = changed[sub_grids].any(axis=1).reshape(-1)
+      previous = {name: [signature, row] for row, (name, signature) in enumerate(zip(names, signatures))
+                  if not invalid[row]}
+    invalid = np.array([previous.get(name, [None])[0] != signature for name, signature in zip(names, signatures)])
+
+    store = None
+    if storage == 'memmap':
+      #  rows of the store are only reused where the same row holds the same embedding
+      shape = (len(index),) + embeddings.shape[2:]
+      if isfile(self.path('embeddings', 'interp.npy')):
+        store = self.open_interp_store('r+')
+        if store.shape[1:] != shape[1:] or store.dtype != dtype:
+          del store
+          store = None
+      missing = np.array([store is None or previous.get(name, [None, None])[1] != row
+                          for row, name in enumerate(names)])
+      if store is not None and store.shape != shape:
+        #  resize, keeping the rows that stay in place
+        old_store, store = store, np.lib.format.open_memmap(self.path('embeddings', 'interp.next.npy'), mode='w+',
+                                                            dtype=dtype, shape=shape)
+        keep = np.flatnonzero(~missing[:len(old_store)])
+        store[keep] = old_store[keep]
+        store.flush()
+        del old_store, store
+        os.replace(self.path('embeddings', 'interp.next.npy'), self.path('embeddings', 'interp.npy'))
+        store = self.open_interp_store('r+')
+      if store is None:
+        store = np.lib.format.open_memmap(self.path('embeddings', 'interp.npy'), mode='w+', dtype=dtype, shape=shape)
+    else:
+      missing = np.array([is_unique and not isfile(os.path.join(interp_dir, name + '.npy'))
+                          for name, is_unique in zip(names, unique)])
+
+    #  audio generated from invalid embeddings has to be generated again
+    for row in np.flatnonzero(invalid):
+      if isfile(self.generated_file(names[row])):
+        os.remove(self.generated_file(names[row]))
+
+    #  duplicates are never generated, only the embedding of their source row is needed
+    stale = ((invalid | missing) & unique).reshape(len(x), len(pitches))
+    print("Interpolating %i of %i embeddings (%i unique)" % (stale.sum(), stale.size, unique.sum()))
+
+    #  interpolate a bounded number of grid points at a time to cap memory use
+    for start in range(0, len(x), chunk_size):
+      stop = min(start + chunk_size, len(x))
+      for p, pitch in enumerate(pitches):
+        ids = np.arange(start, stop)[stale[start:stop, p]]
+        if not len(ids):
+          continue
+        corner_embeddings = embeddings[sub_grids[ids], p]
+        interp = (corner_embeddings * weights[ids, :, None, None]).sum(axis=1)
+
+        if storage == 'memmap':
+          store[ids * len(pitches) + p] = interp.astype(dtype)
+          continue
+
+        for i, idx in enumerate(ids):
+          np.save(os.path.join(interp_dir, names[idx * len(pitches) + p] + '.npy'), interp[i].astype(np.float32))
+
+    if store is not None:
+      store.flush()
+      del store
+
+    self.save_row_signatures({name: [signature, row] for row, (name, signature) in enumerate(zip(names, signatures))})
+    for reference, embedding_hash in embedding_hashes.items():
+      manifest.set_item('interpolation', reference, embedding_hash)
+    manifest.complete('interpolation', [self.path('embeddings', 'interp_index.npy'),
+                                        self.path('embeddings', 'interp_rows.json')])
+
+  def row_signatures(self, index, instruments, sub_grids, weights, embedding_hashes):
+    #  what the embedding of every row is computed from: its corner embeddings, their weights and the dtype
+    dtype = np.dtype(self.settings.get('interp_dtype', 'float32')) \
+        if self.settings.get('interp_storage', 'files') == 'memmap' else np.dtype(np.float32)
+    signatures = []
+    for entry in index:
+      corners = ['{}_{}'.format(instruments[i], entry['pitch']) for i in sub_grids[entry['idx']]]
+      signatures.append(digest([[embedding_hashes[corner] for corner in corners],
+                                np.round(weights[entry['idx']], 9).tolist(), dtype.str]))
+    return signatures
+
+  def load_row_signatures(self):
+    #  name -> [signature, row] of the last interpolation, None before the first one
+    try:
+      with open(self.path('embeddings', 'interp_rows.json'), 'r') as infile:
+        return json.load(infile)
+    except (OSError, ValueError):
+      return None
+
+  def save_row_signatures(self, signatures):
+    temp_path = self.path('embeddings', 'interp_rows.json.tmp')
+    with open(temp_path, 'w') as outfile:
+      json.dump(signatures, outfile)
+    os.replace(temp_path, self.path('embeddings', 'interp_rows.json'))
+
+  def generated_file(self, name):
+    return self.path('audio', 'raw_wav', 'gen_' + name + '.wav')
+
+  def preview_file(self, name):
+    return self.path('audio', 'preview_wav', 'gen_' + name + '.wav')
+
+  def grid_name(self):
+    return self.settings['name'] + '_preview' if self.preview else self.settings['name']
+
+  def preview_anchors(self):
+    #  evenly spaced pitches, always including the lowest and highest
+    pitches = self.settings['pitches']
+    count = max(1, min(self.settings.get('preview_anchors', 4), len(pitches)))
+    return sorted(set(pitches[int(round(i))] for i in np.linspace(0, len(pitches) - 1, count)))
+
+  def duplicate_names(self, index):
+    #  names of the rows sharing the embedding of each unique row
+    names = self.interp_names(index)
+    duplicates = {}
+    for row in np.flatnonzero(index['source'] != np.arange(len(index))):
+      duplicates.setdefault(names[index['source'][row]], []).append(names[row])
+    return duplicates
+
+  def fan_out(self, name, duplicates):
+    #  duplicates share the audio generated for their source embedding
+    linked = []
+    for duplicate in duplicates.get(name, ()):
+      if not isfile(self.generated_file(duplicate)):
+        try:
+          os.link(self.generated_file(name), self.generated_file(duplicate))
+        except FileExistsError:
+          continue
+        linked.append(basename(self.generated_file(duplicate)))
+    return linked
+
+  def unique_embeddings(self, index):
+    #  (level, name) of the rows whose audio has to be generated, the coarse levels of the grid first;
+    #  a unique embedding is needed as early as the coarsest of the rows sharing it
+    names = self.interp_names(index)
+    levels = self.grid_levels(index)
+    np.minimum.at(levels, index['source'], levels.copy())
+    rows = np.flatnonzero(index['source'] == np.arange(len(index)))
+    if self.preview:
+      rows = rows[np.isin(index['pitch'][rows], self.preview_anchors())]
+    return [(int(levels[row]), names[row]) for row in rows[np.argsort(levels[rows], kind='stable')]]
+
+  def batch_embeddings(self):
+    #  coarse levels of the grid first, so stopping early still leaves a usable lower resolution grid
+    index = self.load_interp_index()
+    unique = [name for _, name in self.unique_embeddings(index)]
+
+    #  audio already generated for a unique embedding is shared with duplicates that lack it
+    duplicates = self.duplicate_names(index)
+    for name in unique:
+      if name in duplicates and isfile(self.generated_file(name)):
+        self.fan_out(name, duplicates)
+
+    #  only embeddings without generated audio are (re)batched, except when distributed,
+    #  where every host has to derive the same chunks and skips finished ones itself
+    pending = unique if self.distributed else [name for name in unique if not isfile(self.generated_file(name))]
+
+    #  small chunks, handed out to the workers while generation runs; distributed chunks are named after
+    #  their embeddings as well, so the markers of a chunk that held other names are never mistaken for its own
+    chunk_size = self.settings.get('chunk_size') or self.settings['batch_size_generate']
+    chunks = []
+    for i, start in enumerate(range(0, len(pending), chunk_size)):
+      names = pending[start:start + chunk_size]
+      chunk_id = '%06d-%s' % (i, digest(names)[:12]) if self.distributed else '%06d' % i
+      chunks.append(Chunk(chunk_id, names))
+    return chunks
+
+  #  format call to nsynth_generate
+  def gen_command(self, source_path, save_path, gpu):
+    settings = self.settings
+    return ["nsynth_generate",
+      "--checkpoint_path=%s/model.ckpt-200000" % settings['checkpoint_dir'],
+      "--source_path=%s" % source_path,
+      "--save_path=%s" % save_path,
+      "--sample_length=%s" % settings["final_length"],
+      "--batch_size=%i" % settings["batch_size_generate"],
+      "--log=INFO",
+      "--gpu_number=%s" % gpu]
+
+  def resident_command(self, gpu):
+    #  long-lived worker decoding chunks with a decoder loaded once
+    settings = self.settings
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resident.py'),
+      "--backend=%s" % settings['resident_decoder'],
+      "--checkpoint_path=%s/model.ckpt-200000" % settings['checkpoint_dir'],
+      "--batch_size=%i" % settings["batch_size_generate"],
+      "--sample_length=%s" % settings["final_length"],
+      "--gpu_number=%s" % gpu]
+
+  def chunk_paths(self, chunk):
+    #  staging directories are per host, a chunk whose lease expired may still be running elsewhere
+    staging_id = self.host_id + '_' + chunk.chunk_id if self.distributed else chunk.chunk_id
+    return self.path('embeddings', 'chunks', staging_id), self.path('audio', 'chunks', staging_id)
+
+  def stage_embeddings(self, names, source_path, rows):
+    #  write the embeddings of a chunk, linking so the interpolated files stay in place for later runs
+    if self.settings.get('interp_storage', 'files') == 'memmap':
+      store = self.open_interp_store()
+      for name in names:
+        np.save(os.path.join(source_path, name + '.npy'), store[rows[name]].astype(np.float32))
+    else:
+      for name in names:
+        os.link(self.path('embeddings', 'interp', name + '.npy'), os.path.join(source_path, name + '.npy'))
+
+  def staging_paths(self, chunk):
+    #  empty staging directories for the embeddings and audio of a chunk
+    source_path, save_path = self.chunk_paths(chunk)
+    for path in (source_path, save_path):
+      shutil.rmtree(path, ignore_errors=True)
+      os.makedirs(path)
+    return source_path, save_path
+
+  def prepare_chunk(self, chunk, gpu, rows):
+    source_path, save_path = self.staging_paths(chunk)
+    self.stage_embeddings(chunk.names, source_path, rows)
+    return self.chunk_job(source_path, save_path, gpu)
+
+  def chunk_job(self, source_path, save_path, gpu):
+    if self.settings.get('resident_decoder'):
+      return (self.resident_command(gpu), dict(os.environ),
+              {'source_path': source_path, 'save_path': save_path})
+    return self.gen_command(source_path, save_path, gpu), dict(os.environ)
+
+  def finish_chunk(self, chunk, success, duplicates):
+    source_path, save_path = self.chunk_paths(chunk)
+
+    #  wavs are rewritten while they are generated, only keep them once the process succeeded
+    generated = []
+    if success:
+      for name in chunk.names:
+        if isfile(os.path.join(save_path, 'gen_' + name + '.wav')):
+          os.replace(os.path.join(save_path, 'gen_' + name + '.wav'), self.generated_file(name))
+          generated.append(basename(self.generated_file(name)))
+          generated.extend(self.fan_out(name, duplicates))
+    shutil.rmtree(source_path, ignore_errors=True)
+    shutil.rmtree(save_path, ignore_errors=True)
+    return generated
+
+  def generate_audio(self, chunks, on_generated=None):
+    os.makedirs(self.path('audio', 'raw_wav'), exist_ok=True)
+    index = self.load_interp_index()
+    rows = {name: row for row, name in enumerate(self.interp_names(index))}
+    duplicates = self.duplicate_names(index)
+
+    def finish(chunk, success):
+      generated = self.finish_chunk(chunk, success, duplicates)
+      if on_generated is not None and generated:
+        on_generated(generated)
+
+    prepare = lambda chunk, gpu: self.prepare_chunk(chunk, gpu, rows)
+    is_done = lambda name: isfile(self.generated_file(name))
+    return self.supervise(chunks, prepare, finish, is_done)
+
+  def supervise(self, chunks, prepare, finish, is_done):
+    #  run the chunks on the workers of this host, returns the names that could not be generated
+    from telemetry import GenerationTelemetry
+    settings = self.settings
+
+    #  one worker per gpu, or cpu_workers processes when there are no gpus
+    devices = list(range(settings['gpus'])) or [-1] * settings.get('cpu_workers', 1)
+    log_dir = self.path('logs', self.host_id) if self.distributed else self.path('logs')
+    os.makedirs(log_dir, exist_ok=True)
+
+    total = sum(1 for chunk in chunks for name in chunk.names if not is_done(name))
+    metrics_path = self.path('metrics-%s.json' % self.host_id if self.distributed else 'metrics.json')
+    telemetry = GenerationTelemetry(devices, total, settings['final_length'], metrics_path,
+                                    lambda: supervisor.queue_depth(),
+                                    extra={'batch_size_generate': settings['batch_size_generate'],
+                                           'chunk_size': len(chunks[0].names) if chunks else 0})
+    options = dict(max_retries=settings.get('max_retries', 2), log_dir=log_dir, telemetry=telemetry,
+                   runner=ResidentRunner() if settings.get('resident_decoder') else None)
+    if self.distributed:
+      leases = LeaseQueue(self.path('distributed'), self.host_id, settings.get('lease_ttl', 300))
+      supervisor = DistributedSupervisor(leases, devices, prepare, finish, is_done,
+                                         poll_interval=settings.get('lease_poll_interval', 10), **options)
+    else:
+      supervisor = GenerationSupervisor(devices, prepare, finish, is_done, **options)
+    try:
+      failed = supervisor.run(chunks)
+    finally:
+      telemetry.close()
+    if failed:
+      print("%i embeddings could not be generated, see %s" % (len(failed), log_dir))
+    return failed
+
+  def generate(self):
+    chunks = self.batch_embeddings()
+    if not chunks:
+      print("Audio has already been generated for every embedding, skipping generation")
+      return
+
+    print("Generate audio from embeddings (this may take a while!)\n")
+    #  optionally clean each wav as soon as it has been generated
+    #  (preview samples only exist once every anchor has been generated)
+    cleaner = None
+    if self.settings.get('stream_cleaning', False) and not self.preview:
+      workers = self.settings.get('clean_workers') or os.cpu_count()
+      cleaner = StreamingCleaner(self, workers, self.settings.get('max_inflight') or 2 * workers)
+    try:
+      self.generate_audio(chunks, on_generated=cleaner.submit if cleaner is not None else None)
+    except KeyboardInterrupt:
+      print("\nGeneration stopped, continuing with the samples generated so far")
+    finally:
+      if cleaner is not None:
+        cleaner.close()
+
+  def derive_preview(self):
+    #  fill in every pitch of the preview grid from the nearest decoded anchor pitch at the same point
+    from tqdm import tqdm
+    manifest = self.manifest
+    index = self.load_interp_index()
+    names = self.interp_names(index)
+    pitches = list(self.settings['pitches'])
+    anchors = self.preview_anchors()
+    os.makedirs(self.path('audio', 'preview_wav'), exist_ok=True)
+
+    manifest.begin('preview', digest([pitches, anchors]))
+    jobs = []
+    for row, name in enumerate(names):
+      pitch = index['pitch'][row]
+      anchor = min(anchors, key=lambda anchor: (abs(anchor - pitch), anchor))
+      anchor_file = self.generated_file(names[row - pitches.index(pitch) + pitches.index(anchor)])
+      if not isfile(anchor_file):
+        continue
+      anchor_hash = digest_file(anchor_file)
+      if manifest.item_fresh('preview', name, anchor_hash) and isfile(self.preview_file(name)):
+        continue
+      jobs.append((name, anchor_file, int(pitch - anchor), anchor_hash))
+
+    print("Deriving %i preview samples from %i anchor pitches" % (len(jobs), len(anchors)))
+    if jobs:
+      with ProcessPoolExecutor(max_workers=self.settings.get('clean_workers') or os.cpu_count()) as pool:
+        list(tqdm(pool.map(shift_pitch, [job[1] for job in jobs], [job[2] for job in jobs],
+                           [self.preview_file(job[0]) for job in jobs]), total=len(jobs)))
+      for name, _, _, anchor_hash in jobs:
+        manifest.set_item('preview', name, anchor_hash)
+    manifest.complete('preview')
+
+  def cleaned_file(self, fpath):
+    #  gen_<name>_<point>.wav becomes <grid name>_<point>.mp3
+    return self.grid_name() + fpath.replace('gen_', '')[len(self.settings['name']):].replace('.wav', '.mp3')
+
+  def clean_paths(self):
+    #  mp3s are staged in the working dir, only those of the completed grid are published by publish_files
+    original_path = self.path('audio', 'preview_wav' if self.preview else 'raw_wav')
+    cleaned_path = self.path('audio', 'mp3')
+    os.makedirs(self.output_dir, exist_ok=True)
+    os.makedirs(cleaned_path, exist_ok=True)
+    return original_path, cleaned_path
+
+  def publish_files(self):
+    #  link the mp3s of the grid the options file describes into the grid folder, and remove any others,
+    #  since the MaxForLive device loads every sample in the folder
+    if self.settings.get('output_format', 'files') == 'packed':
+      return
+    _, cleaned_path = self.clean_paths()
+    grid_dir = os.path.join(self.output_dir, self.grid_name())
+    os.makedirs(grid_dir, exist_ok=True)
+    published = set(self.cleaned_file(f) for f in self.output_files())
+    for mp3 in published:
+      source, target = os.path.join(cleaned_path, mp3), os.path.join(grid_dir, mp3)
+      if not isfile(source) or (isfile(target) and os.path.samefile(source, target)):
+        continue
+      try:
+        os.link(source, target + '.tmp')
+      except OSError:
+        #  the output folder may be on another file system
+        shutil.copy2(source, target + '.tmp')
+      os.replace(target + '.tmp', target)
+    for mp3 in os.listdir(grid_dir):
+      if mp3.endswith('.mp3') and mp3 not in published:
+        os.remove(os.path.join(grid_dir, mp3))
+
+  def output_files(self):
+    #  wav files of the rows of the current grid up to its completed level, the same grid the options file
+    #  describes; audio of partly generated finer levels and of other grid settings is not cleaned
+    index = self.load_interp_index()
+    level = self.completed_level(index)
+    if level is None:
+      return set()
+    names = self.interp_names(index)
+    return set('gen_' + names[row] + '.wav' for row in np.flatnonzero(self.grid_levels(index) <= level))
+
+  def is_cleaned(self, fpath, fpath_hash, cleaned_path):
+    return (self.manifest.item_fresh('clean', fpath, fpath_hash) and
+            isfile(os.path.join(cleaned_path, self.cleaned_file(fpath))))
+
+  def clean_files(self):
+    from tqdm import tqdm
+    manifest = self.manifest
+    original_path, cleaned_path = self.clean_paths()
+
+    output_files = self.output_files()
+    files = [f for f in os.listdir(original_path) if f in output_files]
+
+    #  skip files whose mp3 was written from the same wav by an earlier run
+    manifest.begin('clean', digest([self.grid_name()]))
+    hashes = {fpath: digest_file(os.path.join(original_path, fpath)) for fpath in files}
+    files = sorted(f for f in files if not self.is_cleaned(f, hashes[f], cleaned_path))
+
+    #  spread files over a pool of processes, results come back in order
+    workers = self.settings.get('clean_workers') or os.cpu_count()
+    jobs = [(fpath, original_path, cleaned_path, self.cleaned_file(fpath)) for fpath in files]
+    pool = None
+    if workers > 1:
+      pool = ProcessPoolExecutor(max_workers=workers)
+      results = pool.map(_clean_file_isolated, jobs, chunksize=max(1, min(32, len(jobs) // (workers * 4))))
+    else:
+      results = map(_clean_file_isolated, jobs)
+
+    failures = {}
+    for i, (fpath, error) in enumerate(tqdm(zip(files, results), total=len(files))):
+      if error is not None:
+        failures[fpath] = error
+        tqdm.write("Failed to clean %s (%s)" % (fpath, error))
+        continue
+      manifest.set_item('clean', fpath, hashes[fpath])
+      if i % 100 == 99:
+        manifest.save()
+
+    if pool is not None:
+      pool.shutdown()
+
+    if failures:
+      #  leave the stage unfinished so a rerun retries only the failed files
+      manifest.save()
+      with open(self.path('clean_failures.txt'), 'w') as outfile:
+        for fpath in sorted(failures):
+          outfile.write("%s\t%s\n" % (fpath, failures[fpath]))
+      print("%i of %i files could not be cleaned, see %s" % (len(failures), len(files), self.path('clean_failures.txt')))
+      self.publish_files()
+      return
+
+    manifest.complete('clean')
+    self.publish_files()
+
+  def pack_output(self):
+    #  pack every sample of the grid into a single archive with an offset index
+    if self.settings.get('output_format', 'files') == 'files':
+      return
+    _, cleaned_path = self.clean_paths()
+    grid_dir = os.path.join(self.output_dir, self.grid_name())
+    output_files = set(self.cleaned_file(f) for f in self.output_files())
+    samples = sorted(os.path.join(cleaned_path, f) for f in os.listdir(cleaned_path) if f in output_files)
+
+    fingerprint = digest([[basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in samples])
+    if self.manifest.is_complete('pack', fingerprint):
+      return
+    self.manifest.begin('pack', fingerprint)
+    pack_grid(samples, grid_dir)
+    self.manifest.complete('pack', [os.path.join(grid_dir, PACK_FILE)])
+
+  def generate_options_file(self):
+    settings = self.settings
+    outut_file = os.path.join(self.output_dir, self.grid_name(), 'options')
+
+    instrument_grid = settings['instruments']
+
+    #  describe the finest level of the grid that was generated completely
+    stride = self.completed_stride()
+    if stride is None:
+      print("Not even the corners of the grid have been generated, skipping the options file")
+      return
+    if stride > 1:
+      print("Only every %ith point of the grid has been generated, writing the options of a %ix%i grid" % (
+        stride, self.grid_resolution() // stride, self.grid_resolution() // stride))
+
+    min_pitch                      = str(settings['pitches'][0])
+    half_steps_between_pitches     = str(settings['pitches'][1] - settings['pitches'][0])
+    pitches_per_initial_instrument = str(len(settings['pitches']))
+    num_interpolations             = str(self.grid_resolution() // stride)
+    num_instruments                = str(len(instrument_grid))
+    name                           = self.grid_name()
+
+    fingerprint = digest([min_pitch, half_steps_between_pitches, pitches_per_initial_instrument,
+                          num_interpolations, num_instruments, name])
+    if self.manifest.is_complete('options', fingerprint):
+      return
+    self.manifest.begin('options', fingerprint)
+    os.makedirs(os.path.dirname(outut_file), exist_ok=True)
+
+    with open(outut_file, 'w') as options:
+      options.write('1, ')
+      options.write(min_pitch)
+      options.write(' ')
+      options.write(half_steps_between_pitches)
+      options.write(' ')
+      options.write(pitches_per_initial_instrument)
+      options.write(' ')
+      options.write(num_interpolations)
+      options.write(' ')
+      options.write(num_interpolations)
+      options.write(' ')
+      options.write(num_instruments)
+      options.write(' ')
+      options.write(num_instruments)
+      options.write(' ')
+      options.write(name)
+      options.write(';')
+
+    self.manifest.complete('options', [outut_file])
+
+  def run(self):
+    #  every stage in order, each one skips the work finished by earlier runs
+    print("\nComputing embeddings for each instrument at each pitch...\n")
+    self.compute_embeddings()
+    self.correct_truncated_names()
+
+    print("\nInterpolating embeddings between instruments at each pitch...")
+    self.interpolate_embeddings()
+
+    print("\nBatchings embeddings for GPU(s)...")
+    self.generate()
+
+    if self.preview:
+      print("\nPitch shifting the anchor pitches for the preview grid...\n")
+      self.derive_preview()
+
+    print("\nCleaning up generated audio files...\n")
+    self.clean_files()
+    self.pack_output()
+
+    self.generate_options_file()
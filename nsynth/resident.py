@@ -0,0 +1,226 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Long-lived generation workers that load the decoder once instead of starting
+# nsynth_generate, and reloading the checkpoint, for every chunk.
+#
+# A worker process reads one JSON request per line on stdin, naming a
+# directory of embeddings and a directory for the audio, and answers with one
+# JSON line on stdout once the chunk is done; a {"shutdown": true} request, or
+# the end of stdin, makes it exit. Embeddings are decoded in batches
+# of exactly batch_size (the last one padded), and every batch is written out
+# as soon as it is decoded. ResidentRunner keeps one such process per
+# supervisor worker.
+#
+# The decoder is pluggable: 'wavenet' is the NSynth WaveNet of magenta, and
+# 'stand_in' is a cheap numpy synthesizer for machines without a GPU or
+# checkpoint.
+#
+#   python resident.py --backend stand_in --batch_size 8 --sample_length 64000
+import argparse, json, os, subprocess, sys, threading, time
+import numpy as np
+
+HOP_LENGTH = 512
+#  seconds an idle worker gets to exit after the shutdown request before it is terminated
+SHUTDOWN_TIMEOUT = 30
+
+
+class WaveNetDecoder(object):
+  #  same sampling loop as magenta's fastgen.synthesize, with the graph built and restored once
+
+  def __init__(self, checkpoint_path, batch_size, gpu=-1):
+    #  select the device before tensorflow initializes, as nsynth_generate --gpu_number does
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu) if gpu >= 0 else ''
+    import tensorflow as tf
+    from magenta.models.nsynth import utils
+    from magenta.models.nsynth.wavenet import fastgen
+    from magenta.models.nsynth.wavenet.h512_bo16 import Config
+    self.utils = utils
+    self.fastgen = fastgen
+    self.batch_size = batch_size
+    self.hop_length = Config().ae_hop_length
+
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.net = fastgen.load_fastgen_nsynth(batch_size=batch_size)
+      #  the fast generation queues are drained before every batch so init_ops can refill them
+      self.reset_ops = []
+      for op in self.graph.get_operations():
+        if op.type in ('FIFOQueue', 'FIFOQueueV2'):
+          queue = tf.QueueBase(dtypes=[tf.float32], shapes=None, names=None, queue_ref=op.outputs[0])
+          self.reset_ops.append(queue.dequeue_many(queue.size()))
+      self.session = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+      tf.train.Saver().restore(self.session, checkpoint_path)
+
+  def decode(self, encodings):
+    self.session.run(self.reset_ops)
+    self.session.run(self.net['init_ops'])
+    total_length = encodings.shape[1] * self.hop_length
+    audio_batch = np.zeros((self.batch_size, total_length), dtype=np.float32)
+    audio = np.zeros([self.batch_size, 1])
+    for sample_i in range(total_length):
+      enc_i = sample_i // self.hop_length
+      pmf = self.session.run([self.net['predictions'], self.net['push_ops']],
+                             feed_dict={self.net['X']: audio, self.net['encoding']: encodings[:, enc_i, :]})[0]
+      sample_bin = self.fastgen.sample_categorical(pmf)
+      audio = self.utils.inv_mu_law_numpy(sample_bin - 128)
+      audio_batch[:, sample_i] = audio[:, 0]
+    return audio_batch
+
+
+class StandInDecoder(object):
+  #  a sine per embedding whose pitch and loudness follow its first two channels
+
+  def __init__(self, batch_size):
+    self.batch_size = batch_size
+    self.hop_length = HOP_LENGTH
+
+  def decode(self, encodings):
+    frames = np.repeat(encodings, self.hop_length, axis=1)
+    frequency = 220.0 * 2 ** np.tanh(frames[..., 0])
+    amplitude = 0.5 / (1 + np.exp(-frames[..., 1]))
+    phase = 2 * np.pi * np.cumsum(frequency / 16000.0, axis=1)
+    return (amplitude * np.sin(phase)).astype(np.float32)
+
+
+DECODERS = ['wavenet', 'stand_in']
+
+
+def load_decoder(backend, checkpoint_path, batch_size, gpu):
+  if backend == 'wavenet':
+    return WaveNetDecoder(checkpoint_path, batch_size, gpu)
+  if backend == 'stand_in':
+    return StandInDecoder(batch_size)
+  raise ValueError("Unknown decoder backend %s, use one of %s" % (backend, ', '.join(DECODERS)))
+
+
+def generate_chunk(decoder, source_path, save_path, sample_length):
+  from pipeline import write_wav
+  names = sorted(f[:-len('.npy')] for f in os.listdir(source_path) if f.endswith('.npy'))
+  frames = sample_length // decoder.hop_length
+  for start in range(0, len(names), decoder.batch_size):
+    batch = names[start:start + decoder.batch_size]
+    encodings = [np.load(os.path.join(source_path, name + '.npy'))[:frames] for name in batch]
+
+    #  the last batch is padded, so the decoder only ever sees one shape
+    encodings += [np.zeros_like(encodings[0])] * (decoder.batch_size - len(batch))
+    start_time = time.time()
+    audio = decoder.decode(np.stack(encodings))
+    for name, samples in zip(batch, audio):
+      write_wav(os.path.join(save_path, 'gen_' + name + '.wav'), samples)
+    print("Generated %i samples in %.1f s" % (len(batch), time.time() - start_time), file=sys.stderr, flush=True)
+  return len(names)
+
+
+def serve(decoder, sample_length, requests, responses):
+  for line in requests:
+    request = json.loads(line)
+    if request.get('shutdown'):
+      return
+    try:
+      generated = generate_chunk(decoder, request['source_path'], request['save_path'], sample_length)
+      response = {'ok': True, 'generated': generated}
+    except Exception as e:
+      print("Failed to generate %s: %s: %s" % (request['source_path'], type(e).__name__, e), file=sys.stderr, flush=True)
+      response = {'ok': False, 'error': "%s: %s" % (type(e).__name__, e)}
+    responses.write(json.dumps(response) + '\n')
+    responses.flush()
+
+
+class ResidentRunner(object):
+  #  runner for GenerationSupervisor, the job of a chunk is (command, env, request);
+  #  each worker keeps its process running the command and sends it the requests
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.processes = {}
+    self.stopped = False
+
+  def _process(self, worker, command, env, log):
+    with self.lock:
+      process = self.processes.get(worker)
+      if process is None or process.poll() is not None:
+        #  (re)start the worker, its log outlives the handle of this chunk
+        process = subprocess.Popen(command, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=log, universal_newlines=True)
+        self.processes[worker] = process
+        if self.stopped:
+          process.terminate()
+      return process
+
+  def run(self, worker, job, log):
+    command, env, request = job
+    process = self._process(worker, command, env, log)
+    try:
+      process.stdin.write(json.dumps(request) + '\n')
+      process.stdin.flush()
+      response = process.stdout.readline()
+    except (BrokenPipeError, ValueError):
+      response = ''
+    if not response:
+      #  the process died, make sure it is gone so the next chunk starts a new one
+      process.kill()
+      process.wait()
+      with self.lock:
+        if self.processes.get(worker) is process:
+          del self.processes[worker]
+      return False
+    return json.loads(response).get('ok', False)
+
+  def stop(self):
+    with self.lock:
+      self.stopped = True
+      for process in self.processes.values():
+        process.terminate()
+
+  def close(self):
+    #  ask the workers to exit once they are idle; closing stdin alone is not enough, processes forked
+    #  since they started (like the pool of the streaming cleaner) hold on to the write end of the pipe
+    with self.lock:
+      processes = list(self.processes.values())
+      self.processes = {}
+    for process in processes:
+      try:
+        process.stdin.write(json.dumps({'shutdown': True}) + '\n')
+        process.stdin.close()
+      except (BrokenPipeError, ValueError):
+        pass
+    for process in processes:
+      try:
+        process.wait(timeout=SHUTDOWN_TIMEOUT)
+      except subprocess.TimeoutExpired:
+        process.terminate()
+        process.wait()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Decode chunks of embeddings with a decoder loaded once.')
+  parser.add_argument('--backend', default='wavenet', choices=DECODERS)
+  parser.add_argument('--checkpoint_path', default=None)
+  parser.add_argument('--batch_size', type=int, required=True)
+  parser.add_argument('--sample_length', type=int, required=True)
+  parser.add_argument('--gpu_number', type=int, default=-1)
+  args = parser.parse_args()
+
+  #  keep stdout for the responses, anything printed by the decoder goes to the log
+  responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+  os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+  decoder = load_decoder(args.backend, args.checkpoint_path, args.batch_size, args.gpu_number)
+  print("Loaded the %s decoder" % args.backend, file=sys.stderr, flush=True)
+  serve(decoder, args.sample_length, sys.stdin, responses)
+
+
+if __name__ == "__main__":
+  main()
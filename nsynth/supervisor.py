@@ -0,0 +1,198 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs nsynth_generate workers over small chunks of embeddings.
+#
+# Every worker owns a deque of chunks. Workers take chunks from the front of
+# their own deque and, once it is empty, steal from the back of the longest
+# deque of another worker, so a slow or crashed worker never holds up the grid.
+# Chunks whose process fails are retried with only their missing outputs.
+import collections, os, subprocess, threading, time
+
+
+class ProcessRunner(object):
+  #  runs every chunk in a process of its own, the job of a chunk is (command, env)
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.processes = {}
+    self.stopped = False
+
+  def run(self, worker, job, log):
+    command, env = job
+    process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    with self.lock:
+      self.processes[worker] = process
+      if self.stopped:
+        process.terminate()
+    try:
+      return process.wait() == 0
+    finally:
+      with self.lock:
+        self.processes.pop(worker, None)
+
+  def stop(self):
+    with self.lock:
+      self.stopped = True
+      for process in self.processes.values():
+        process.terminate()
+
+  def close(self):
+    pass
+
+
+class Chunk(object):
+
+  def __init__(self, chunk_id, names, attempts=0):
+    self.chunk_id = chunk_id
+    self.names = list(names)
+    self.attempts = attempts
+
+
+class GenerationSupervisor(object):
+  """Feeds chunks to one worker thread per device.
+
+  prepare(chunk, device) returns the job generating a chunk, which runner
+  executes (by default a (command, env) pair run by ProcessRunner),
+  finish(chunk, success) is called once the job is over and is_done(name)
+  tells whether the output of an embedding exists.
+  """
+
+  def __init__(self, devices, prepare, finish, is_done, max_retries=2, log_dir=None, telemetry=None, runner=None):
+    self.devices = list(devices)
+    self.prepare = prepare
+    self.finish = finish
+    self.is_done = is_done
+    self.max_retries = max_retries
+    self.log_dir = log_dir
+    self.telemetry = telemetry
+    self.runner = runner or ProcessRunner()
+
+    self.lock = threading.Lock()
+    self.queues = [collections.deque() for _ in self.devices]
+    self.failed = []
+    self.stopping = False
+
+  def _next_chunk(self, worker):
+    with self.lock:
+      if self.stopping:
+        return None
+      if self.queues[worker]:
+        return self.queues[worker].popleft()
+      #  steal from the back of the longest queue
+      victim = max(range(len(self.queues)), key=lambda i: len(self.queues[i]))
+      if self.queues[victim]:
+        return self.queues[victim].pop()
+      return None
+
+  def queue_depth(self):
+    #  number of embeddings waiting in the queues
+    with self.lock:
+      return sum(len(chunk.names) for queue in self.queues for chunk in queue)
+
+  def _requeue(self, chunk):
+    with self.lock:
+      min(self.queues, key=len).append(chunk)
+
+  def _run_chunk(self, worker, chunk):
+    job = self.prepare(chunk, self.devices[worker])
+    log = subprocess.DEVNULL
+    if self.log_dir is not None:
+      log = open(os.path.join(self.log_dir, 'worker%i.log' % worker), 'a')
+    try:
+      success = self.runner.run(worker, job, log)
+    finally:
+      if log is not subprocess.DEVNULL:
+        log.close()
+
+    self.finish(chunk, success)
+    return success
+
+  def _work(self, worker):
+    while True:
+      chunk = self._next_chunk(worker)
+      if chunk is None:
+        return
+      self.chunk_started(worker, chunk)
+      start_time = time.time()
+      #  the outcome is judged by the files the chunk produced, see _finish_chunk
+      try:
+        self._run_chunk(worker, chunk)
+      except OSError:
+        pass
+      if self.stopping:
+        return
+      self._finish_chunk(worker, chunk, time.time() - start_time)
+
+  def _finish_chunk(self, worker, chunk, seconds):
+    #  retry whatever the worker did not produce
+    missing = [name for name in chunk.names if not self.is_done(name)]
+    if not missing:
+      self.chunk_done(worker, chunk, seconds)
+      return
+    if chunk.attempts >= self.max_retries:
+      with self.lock:
+        self.failed.extend(missing)
+      self.chunk_failed(worker, chunk, missing, seconds)
+      return
+    self.chunk_retried(worker, chunk, missing, seconds)
+    self._requeue(Chunk(chunk.chunk_id, missing, chunk.attempts + 1))
+
+  #  progress events, forwarded to the telemetry
+  def chunk_started(self, worker, chunk):
+    if self.telemetry is not None:
+      self.telemetry.chunk_started(worker, chunk)
+
+  def chunk_done(self, worker, chunk, seconds):
+    if self.telemetry is not None:
+      self.telemetry.chunk_finished(worker, chunk, len(chunk.names), 0, seconds)
+
+  def chunk_retried(self, worker, chunk, missing, seconds):
+    print("Retrying %i embeddings of chunk %s" % (len(missing), chunk.chunk_id))
+    if self.telemetry is not None:
+      self.telemetry.chunk_finished(worker, chunk, len(chunk.names) - len(missing), 0, seconds)
+
+  def chunk_failed(self, worker, chunk, missing, seconds):
+    print("Giving up on %i embeddings of chunk %s" % (len(missing), chunk.chunk_id))
+    if self.telemetry is not None:
+      self.telemetry.chunk_finished(worker, chunk, len(chunk.names) - len(missing), len(missing), seconds)
+
+  def stop(self):
+    with self.lock:
+      self.stopping = True
+    self.runner.stop()
+
+  def run(self, chunks):
+    """Generates all chunks and returns the names that could not be generated."""
+    for i, chunk in enumerate(chunks):
+      self.queues[i % len(self.queues)].append(chunk)
+    return self._run_workers()
+
+  def _run_workers(self):
+    threads = [threading.Thread(target=self._work, args=(worker,), daemon=True)
+               for worker in range(len(self.devices))]
+    for thread in threads:
+      thread.start()
+    try:
+      while any(thread.is_alive() for thread in threads):
+        time.sleep(0.5)
+    except KeyboardInterrupt:
+      self.stop()
+      for thread in threads:
+        thread.join()
+      raise
+    finally:
+      self.runner.close()
+
+    return self.failed
@@ -0,0 +1,98 @@
+# Copyright 2017 Google Inc
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Generation progress and throughput, driven by the events the supervisor
+# reports when workers start and finish chunks. Every event updates the
+# progress bar, appends a line to <metrics_path>l (JSON lines) and rewrites a
+# JSON snapshot at metrics_path with per-worker rates, ETA and queue depth.
+import json, os, threading, time
+from tqdm import tqdm
+
+
+class GenerationTelemetry(object):
+
+  def __init__(self, devices, total, sample_length, metrics_path, queue_depth, extra=None):
+    self.total = total
+    self.sample_length = sample_length
+    self.metrics_path = metrics_path
+    self.queue_depth = queue_depth
+    self.extra = extra or {}
+
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+    self.completed = 0
+    self.failed = 0
+    self.workers = [{'device': device, 'state': 'idle', 'chunks': 0, 'files': 0, 'busy_seconds': 0.0}
+                    for device in devices]
+    self.pbar = tqdm(total=total, desc="Generated samples")
+
+    os.makedirs(os.path.dirname(metrics_path) or '.', exist_ok=True)
+    self.events = open(metrics_path + 'l', 'a')
+
+  def chunk_started(self, worker, chunk):
+    with self.lock:
+      self.workers[worker]['state'] = 'busy'
+      self._record('chunk_started', worker, chunk)
+
+  def chunk_finished(self, worker, chunk, generated, failed, seconds):
+    with self.lock:
+      stats = self.workers[worker]
+      stats['state'] = 'idle'
+      stats['chunks'] += 1
+      stats['files'] += generated
+      stats['busy_seconds'] += seconds
+      self.completed += generated
+      self.failed += failed
+      self.pbar.update(generated)
+      self._record('chunk_finished', worker, chunk, generated=generated, failed=failed, seconds=seconds)
+
+  def _snapshot(self):
+    elapsed = time.time() - self.start_time
+    rate = self.completed / elapsed if elapsed > 0 else 0.0
+    remaining = self.total - self.completed - self.failed
+    workers = {}
+    for worker, stats in enumerate(self.workers):
+      worker_rate = stats['files'] / stats['busy_seconds'] if stats['busy_seconds'] > 0 else 0.0
+      workers[str(worker)] = dict(stats, files_per_sec=worker_rate, samples_per_sec=worker_rate * self.sample_length)
+    snapshot = {
+      'time': time.time(),
+      'elapsed_seconds': elapsed,
+      'total': self.total,
+      'completed': self.completed,
+      'failed': self.failed,
+      'queue_depth': self.queue_depth(),
+      'files_per_sec': rate,
+      'samples_per_sec': rate * self.sample_length,
+      'eta_seconds': remaining / rate if rate > 0 else None,
+      'workers': workers,
+    }
+    snapshot.update(self.extra)
+    return snapshot
+
+  def _record(self, event, worker, chunk, **values):
+    snapshot = self._snapshot()
+    self.pbar.set_postfix(queue=snapshot['queue_depth'], rate='%.2f/s' % snapshot['files_per_sec'])
+
+    values.update(event=event, worker=worker, chunk=chunk.chunk_id, size=len(chunk.names), time=snapshot['time'])
+    self.events.write(json.dumps(values) + '\n')
+    self.events.flush()
+
+    temp_path = self.metrics_path + '.tmp'
+    with open(temp_path, 'w') as outfile:
+      json.dump(snapshot, outfile, indent=1, sort_keys=True)
+    os.replace(temp_path, self.metrics_path)
+
+  def close(self):
+    self.pbar.close()
+    self.events.close()